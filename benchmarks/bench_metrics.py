@@ -0,0 +1,145 @@
+# bench_metrics.py
+# Times the dashboard's hot computations on synthetic data, fully offline:
+#   python -m benchmarks.bench_metrics --rows 1000000 5000000 20000000
+# Every run is appended to benchmarks/results/results.jsonl and compared with
+# the previous run of the same benchmark and size, so regressions in the
+# computations behind Summary.py and the pages show up as a ratio.
+import os
+import gc
+import sys
+import json
+import time
+import argparse
+import datetime
+import platform
+import statistics
+import subprocess
+import numpy as np
+import pandas as pd
+from ftm_metrics import (get_ra_segments, get_normalized_start_df, build_campaign_index,
+    select_campaign_users, get_rolling_la, get_country_la, downsample_series)
+from benchmarks import synthetic
+
+RESULTS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results', 'results.jsonl')
+
+def get_fixtures(n_rows, seed=0):
+    apps = synthetic.make_apps(seed)
+    countries = synthetic.get_countries()
+    users = synthetic.make_users(n_rows, apps, countries, seed)
+    cube = synthetic.make_cube(users)
+    campaigns = synthetic.make_campaigns(apps, countries, seed=seed)
+    campaigns = pd.merge(campaigns, apps[['language', 'app_id']], how='left', left_on='Language', right_on='language')
+    cube_index = build_campaign_index(cube)
+    campaign_cube = select_campaign_users(cube, cube_index, campaigns)
+    daily_la = campaign_cube.groupby(['campaign', 'LA_date'])['la'].sum().reset_index(name='LA')
+    return {
+        'apps': apps,
+        'countries': countries,
+        'users': users,
+        'cube': cube,
+        'campaigns': campaigns,
+        'cube_index': cube_index,
+        'campaign_cube': campaign_cube,
+        'campaign_costs': campaigns.set_index('Campaign Name')['Total Cost (USD)'],
+        'daily_la': daily_la,
+        'rolling_la': get_rolling_la(daily_la),
+    }
+
+def get_benchmarks(f):
+    # name -> callable over the fixtures, mirroring what the pages compute.
+    total_lvls = f['apps']['total_lvls'].mean()
+    return {
+        'cube_rollup': lambda: synthetic.make_cube(f['users']),
+        'ra_deciles_users': lambda: get_ra_segments(f['users'], total_lvls, costs=10000.0),
+        'ra_deciles_cube_by_campaign': lambda: get_ra_segments(f['campaign_cube'], total_lvls,
+            by='campaign', costs=f['campaign_costs'], weights='la'),
+        'campaign_index': lambda: build_campaign_index(f['cube']),
+        'campaign_select': lambda: select_campaign_users(f['cube'], f['cube_index'], f['campaigns']),
+        'daily_la_groupby': lambda: f['campaign_cube'].groupby(['campaign', 'LA_date'])['la'].sum().reset_index(name='LA'),
+        'daily_la_groupby_users': lambda: f['users'].groupby(['LA_date']).size().reset_index(name='Learners Acquired'),
+        'rolling_la': lambda: get_rolling_la(f['daily_la']),
+        'normalized_start': lambda: get_normalized_start_df(f['rolling_la']),
+        'country_la_cube': lambda: get_country_la(f['cube'], f['countries'], weights='la'),
+        'country_la_users': lambda: get_country_la(f['users'], f['countries']),
+        'downsample_la': lambda: downsample_series(f['rolling_la'], 'LA_date', 'LA', 'campaign', 500),
+    }
+
+def time_call(func, repeat):
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times), statistics.median(times)
+
+def get_git_rev():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+            text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def load_results(path=RESULTS_FILE):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def append_results(records, path=RESULTS_FILE):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+
+def get_previous(results, benchmark, rows):
+    previous = [r for r in results if r['benchmark'] == benchmark and r['rows'] == rows]
+    return previous[-1] if previous else None
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time the dashboard computations on synthetic data.')
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000000], help='ftm_users sizes to run.')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--only', nargs='+', help='Run only these benchmarks.')
+    parser.add_argument('--threshold', type=float, default=1.25,
+        help='Best-time ratio against the previous run above which a benchmark counts as regressed.')
+    parser.add_argument('--fail-on-regression', action='store_true')
+    parser.add_argument('--results', default=RESULTS_FILE)
+    args = parser.parse_args(argv)
+
+    previous_results = load_results(args.results)
+    run = {
+        'run_id': datetime.datetime.now().isoformat(timespec='seconds'),
+        'git_rev': get_git_rev(),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+    }
+    records = []
+    regressions = []
+    for rows in args.rows:
+        fixtures = get_fixtures(rows, args.seed)
+        print(f'rows={rows:,} cube_rows={len(fixtures["cube"]):,} campaign_rows={len(fixtures["campaign_cube"]):,}')
+        for name, func in get_benchmarks(fixtures).items():
+            if args.only and name not in args.only:
+                continue
+            best, median = time_call(func, args.repeat)
+            record = dict(run, rows=rows, benchmark=name, best_s=best, median_s=median)
+            records.append(record)
+            previous = get_previous(previous_results, name, rows)
+            ratio = best / previous['best_s'] if previous else None
+            flag = ''
+            if ratio is not None and ratio > args.threshold:
+                flag = '  REGRESSION'
+                regressions.append(record)
+            ratio_text = f'{ratio:5.2f}x' if ratio is not None else '    -'
+            print(f'  {name:30} best {best * 1000:10.1f} ms  median {median * 1000:10.1f} ms  vs prev {ratio_text}{flag}')
+        del fixtures
+    append_results(records, args.results)
+    if regressions and args.fail_on_regression:
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
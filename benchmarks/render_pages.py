@@ -0,0 +1,464 @@
+# render_pages.py
+# Renders Summary.py and the pages headlessly, fully offline, and replays
+# scripted interactions on each of them:
+#   python -m benchmarks.render_pages --rows 1000000
+# BigQuery and the Google Sheets are served from benchmarks.synthetic, st.secrets
+# is faked, and every rerun runs in a real ScriptRunContext so widgets, session
+# state and the memo caches behave as under `streamlit run`. Each rerun is timed
+# end to end and per page section (the upper-case '# SECTION' comments), split
+# into data load, transform, figure build and serialization. Every run is
+# appended to benchmarks/results/render.jsonl.
+import os
+import tempfile
+# Loader results are cached under a throwaway directory, never the dashboard's
+# own, and the per-call telemetry logs are muted; this has to be set before the
+# ftm modules are imported.
+os.environ['FTM_CACHE_DIR'] = tempfile.mkdtemp(prefix='ftm_render_')
+os.environ.setdefault('FTM_TELEMETRY_LOG_LEVEL', 'WARNING')
+import re
+import sys
+import time
+import uuid
+import shutil
+import inspect
+import argparse
+import datetime
+import functools
+import threading
+import traceback
+import collections
+from concurrent.futures import Future
+from contextlib import contextmanager
+from typing import NamedTuple
+import numpy as np
+import pandas as pd
+import plotly.express as px
+import plotly_calplot
+import streamlit as st
+from streamlit.delta_generator import DeltaGenerator
+from streamlit.runtime.scriptrunner import add_script_run_ctx
+from streamlit.runtime.scriptrunner.script_runner import StopException
+from streamlit.runtime.scriptrunner.script_run_context import ScriptRunContext
+from streamlit.runtime.state import SafeSessionState, SessionState
+from streamlit.runtime.uploaded_file_manager import UploadedFileManager
+import ftm_data
+import ftm_charts
+from ftm_cache import CACHE_DIR
+from benchmarks import synthetic
+from benchmarks.bench_metrics import get_git_rev, append_results
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_FILE = os.path.join(ROOT_DIR, 'benchmarks', 'results', 'render.jsonl')
+# Sheet secret -> name of the offline sheet served for its URL.
+FAKE_SECRETS = {
+    'Campaign_gsheets_url': 'fake://campaigns',
+    'ann_camp_metrics_gsheets_url': 'fake://annual_campaigns',
+    'ftm_apps_gsheets_url': 'fake://apps',
+    'campaign_metrics_gsheets_url': 'fake://campaign_metrics',
+    'gcp_service_account': {},
+}
+# Page sections start at top-level comments like '# MAP' or '# --- UI ---'.
+SECTION_RE = re.compile(r'^# (--- )?[A-Z][A-Z &/-]*[A-Z]( ---)?\s*$')
+CATEGORIES = ['load', 'transform', 'figure', 'serialize']
+# Days after their LA date over which a cohort's levels are spread in the
+# offline ftm_daily_activity.
+ACTIVITY_DAYS = 30
+
+def _to_dates(dates):
+    # Converted once per distinct date; BigQuery DATE columns arrive as
+    # datetime.date objects.
+    codes, uniques = pd.factorize(dates)
+    return pd.Index(uniques).date[codes]
+
+class OfflineSources:
+    '''Synthetic BigQuery tables and sheets answering ftm_data's queries.'''
+    def __init__(self, n_rows, seed=0):
+        self.version = f'offline-{n_rows}-{seed}'
+        self.apps = synthetic.make_apps(seed)
+        self.countries = synthetic.get_countries()
+        self.users = synthetic.make_users(n_rows, self.apps, self.countries, seed)
+        self.cube = synthetic.make_cube(self.users)
+        self.campaigns = synthetic.make_campaigns(self.apps, self.countries, seed=seed)
+        self.users_rows = pd.DataFrame({
+            'user_pseudo_id': pd.RangeIndex(n_rows).astype(str),
+            'LA_date': _to_dates(self.users['LA_date']),
+            'app_id': self.users['app_id'].astype(str),
+            'country': self.users['country'].astype(str),
+            'max_lvl': self.users['max_lvl'].astype('int64'),
+            'max_lvl_date': _to_dates(self.users['max_lvl_date']),
+            'total_lvls_succeeded': self.users['total_lvls_succeeded'].astype('int64'),
+        })
+        self.cube_rows = self.cube.drop(columns='country_iso3').astype({
+            'app_id': str,
+            'country': str,
+            'max_lvl': 'int64',
+            'la': 'int64',
+        }).assign(LA_date=_to_dates(self.cube['LA_date']))
+        # The sheets hold month-granular end dates, load_campaign_data moves
+        # them to the end of the month.
+        campaign_rows = self.campaigns.assign(
+            **{'Start Date': pd.to_datetime(self.campaigns['Start Date']).dt.strftime('%Y-%m-%d'),
+                'End Date': pd.to_datetime(self.campaigns['End Date']).dt.strftime('%Y-%m-01')})
+        self.sheets = {
+            'campaigns': campaign_rows,
+            'annual_campaigns': synthetic.make_annual_metrics(seed),
+            'apps': self.apps,
+            'campaign_metrics': synthetic.make_campaign_metrics(self.campaigns, seed),
+        }
+
+    def run_query(self, query):
+        name = re.search(r'"fake://(\w+)"', query).group(1)
+        sheet = self.sheets[name]
+        match = re.search(r'SELECT (.+?) FROM', query)
+        if match.group(1).strip() != '*':
+            sheet = sheet[[column.strip() for column in match.group(1).split(',')]]
+        return list(sheet.itertuples(index=False, name=None))
+
+    def query_df(self, sql_query, job_config=None, page_size=None):
+        table = re.search(r'FROM\s+`[\w.-]+\.(\w+)`', sql_query).group(1)
+        params = {}
+        if job_config is not None:
+            for param in job_config.query_parameters:
+                params[param.name] = param.values if hasattr(param, 'values') else param.value
+        if table == 'ftm_users_cube' and 'WHERE' in sql_query:
+            return self._get_cube_aggregate(sql_query, params)
+        if table == 'ftm_users_cube':
+            return self.cube_rows.copy()
+        if table == 'ftm_users':
+            mask = self._get_mask(self.users, sql_query, params)
+            return self.users_rows[mask].reset_index(drop=True)
+        if table == 'ftm_daily_activity':
+            return self._get_daily_activity(sql_query, params)
+        raise ValueError(f'No offline stand-in for table {table}')
+
+    def _get_mask(self, rows, sql_query, params):
+        mask = rows['LA_date'].between(pd.Timestamp(params['start']), pd.Timestamp(params['end']))
+        if re.search(r'@app\b', sql_query):
+            mask &= rows['app_id'] == params['app']
+        if 'UNNEST(@apps)' in sql_query:
+            mask &= rows['app_id'].isin(params['apps'])
+        if re.search(r'@country\b', sql_query):
+            mask &= rows['country'] == params['country']
+        if 'UNNEST(@countries)' in sql_query:
+            mask &= rows['country'].isin(params['countries'])
+        return mask.to_numpy()
+
+    def _get_cube_aggregate(self, sql_query, params):
+        # Answers ftm_queries.get_aggregate_sql: the measures are read off the
+        # SELECT aliases, the dimensions off the GROUP BY.
+        rows = self.cube[self._get_mask(self.cube, sql_query, params)]
+        rows = rows.assign(max_lvl_sum=rows['max_lvl'].astype('int64') * rows['la'])
+        measures = re.findall(r' AS (\w+)', sql_query)
+        match = re.search(r'GROUP BY ([\w, ]+)', sql_query)
+        if match is None:
+            return rows[measures].sum().astype('int64').to_frame().T
+        by = [column.strip() for column in match.group(1).split(',')]
+        res = rows.groupby(by, as_index=False, observed=True)[measures].sum().sort_values(by)
+        res = res.astype({column: str for column in by if column in ('app_id', 'country')})
+        if 'LA_date' in by:
+            res['LA_date'] = _to_dates(res['LA_date'])
+        return res.reset_index(drop=True)
+
+    def _get_daily_activity(self, sql_query, params):
+        # Each cohort plays la * max_lvl levels, spread evenly over ACTIVITY_DAYS.
+        cohorts = self.cube[self._get_mask(self.cube, sql_query, params)]
+        offsets = pd.to_timedelta(np.arange(ACTIVITY_DAYS), unit='D')
+        activity = pd.DataFrame({
+            'event_date': np.repeat(cohorts['LA_date'].to_numpy(), ACTIVITY_DAYS) + np.tile(offsets.to_numpy(), len(cohorts)),
+            'levels_played': np.repeat((cohorts['la'] * cohorts['max_lvl']).to_numpy() / ACTIVITY_DAYS, ACTIVITY_DAYS),
+        })
+        activity = activity.groupby('event_date', as_index=False)['levels_played'].sum()
+        activity = activity[activity['event_date'] >= pd.Timestamp(params['start'])]
+        return pd.DataFrame({
+            'event_date': _to_dates(activity['event_date']),
+            'levels_played': activity['levels_played'].round().astype('int64').to_numpy(),
+        })
+
+    def get_version(self, *args):
+        return self.version
+
+def install_sources(sources):
+    # Everything below ftm_data's loaders is served offline: the sheets by URL,
+    # BigQuery by table name, and the Drive and table metadata by a constant.
+    st.secrets = FAKE_SECRETS
+    ftm_data.run_query = sources.run_query
+    ftm_data.query_df = sources.query_df
+    ftm_data.get_sheet_revision = sources.get_version
+    ftm_data.get_table_version = sources.get_version
+
+class Timer:
+    '''Time spent per category during a section. Only the outermost timed call
+    counts, so e.g. a chart helper's px.line is not counted twice, and calls
+    made from loader worker threads are covered by the page thread waiting on them.
+    '''
+    def __init__(self):
+        self.thread = None
+        self.active = False
+        self.times = collections.Counter()
+
+    @contextmanager
+    def timing(self, category):
+        if self.active or threading.current_thread() is not self.thread:
+            yield
+            return
+        self.active = True
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.times[category] += time.perf_counter() - start
+            self.active = False
+
+    def _iter_timed(self, items, category):
+        # Generators (e.g. iter_loaded) are timed per item.
+        try:
+            while True:
+                with self.timing(category):
+                    try:
+                        item = next(items)
+                    except StopIteration:
+                        return
+                yield item
+        finally:
+            items.close()
+
+    def wrap(self, func, category):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with self.timing(category):
+                result = func(*args, **kwargs)
+            if inspect.isgenerator(result):
+                return self._iter_timed(result, category)
+            return result
+        return wrapper
+
+def install_timer(timer):
+    for name, func in list(vars(ftm_data).items()):
+        # Only ftm_data's own loaders (and the stand-ins for them), not its imports.
+        if re.match(r'(get|iter)_', name) and getattr(func, '__module__', None) in ('ftm_data', __name__):
+            setattr(ftm_data, name, timer.wrap(func, 'load'))
+    # The page thread blocking on a background load (ftm_data.start_loads).
+    Future.result = timer.wrap(Future.result, 'load')
+    for name in ['line', 'bar', 'scatter', 'timeline', 'choropleth']:
+        setattr(px, name, timer.wrap(getattr(px, name), 'figure'))
+    plotly_calplot.calplot = timer.wrap(plotly_calplot.calplot, 'figure')
+    for name, func in list(vars(ftm_charts).items()):
+        if name.startswith('get_') and name.endswith('_fig'):
+            setattr(ftm_charts, name, timer.wrap(func, 'figure'))
+    # st.plotly_chart and friends are bound to the main DeltaGenerator at import.
+    for name in ['plotly_chart', 'dataframe', 'table']:
+        setattr(DeltaGenerator, name, timer.wrap(getattr(DeltaGenerator, name), 'serialize'))
+        setattr(st, name, getattr(st._main, name))
+
+# label -> value returned by unkeyed widgets (radios, checkboxes) in the
+# current rerun, in place of their default.
+_widget_values = {}
+
+def install_widget_values():
+    for name in ['radio', 'checkbox', 'selectbox', 'multiselect', 'date_input']:
+        def wrap(func):
+            @functools.wraps(func)
+            def wrapper(dg, label, *args, **kwargs):
+                value = func(dg, label, *args, **kwargs)
+                return _widget_values.get(label, value)
+            return wrapper
+        setattr(DeltaGenerator, name, wrap(getattr(DeltaGenerator, name)))
+        setattr(st, name, getattr(st._main, name))
+
+def split_sections(path):
+    """Returns [(section name, code object)] of the script at path, split at its
+    section comments. Sections that don't compile alone (a comment inside a
+    block) are merged into the next one.
+    """
+    with open(path) as f:
+        lines = f.read().splitlines(keepends=True)
+    starts = [0] + [i for i, line in enumerate(lines) if i > 0 and SECTION_RE.match(line)]
+    sections = []
+    pending = None
+    for start, end in zip(starts, starts[1:] + [len(lines)]):
+        if pending is not None:
+            start = pending
+        name = lines[start].strip() if start in starts[1:] else '(imports)'
+        # Leading newlines keep the line numbers of tracebacks right.
+        source = '\n' * start + ''.join(lines[start:end])
+        try:
+            code = compile(source, path, 'exec')
+        except SyntaxError:
+            pending = start
+            continue
+        pending = None
+        sections.append((name, code))
+    if pending is not None:
+        compile('\n' * pending + ''.join(lines[pending:]), path, 'exec')
+    return sections
+
+class Interaction(NamedTuple):
+    name: str
+    # Keyed widgets, set through st.session_state before the rerun.
+    state: dict = {}
+    # Unkeyed widgets by label, they keep these values for later reruns too.
+    widgets: dict = {}
+
+def get_interactions(sources):
+    campaigns = sources.campaigns['Campaign Name'].tolist()
+    all_countries = sources.campaigns.loc[sources.campaigns['Country'] == 'All', 'Campaign Name']
+    end = (synthetic.START_DATE + pd.Timedelta(synthetic.N_DAYS - 1, unit='D')).date()
+    top_iso3 = sources.users['country_iso3'].value_counts().index[:10]
+    top_countries = sources.countries.loc[sources.countries['alpha3'].isin(top_iso3), 'name'].tolist()
+    return {
+        'Summary.py': [
+            Interaction('initial'),
+            Interaction('normalized start', widgets={'Start Date Toggle': 'Normalized Start'}),
+            Interaction('weekly rolling mean', widgets={'Rolling Mean Toggle': 'Weekly LA Rolling Mean'}),
+            Interaction('monthly rolling mean', widgets={'Rolling Mean Toggle': 'Monthly LA Rolling Mean'}),
+            Interaction('original start', widgets={'Start Date Toggle': 'Original'}),
+        ],
+        'pages/01_Campaign_Comparison_Summary.py': [
+            Interaction('two campaigns', state={'campaigns': campaigns[:2]}),
+            Interaction('all campaigns', state={'campaigns': campaigns}),
+        ],
+        'pages/02_Campaign_Details.py': [
+            Interaction('initial'),
+            Interaction('all-country campaign', state={'campaign': all_countries.iloc[0]}),
+            Interaction('daily reading activity', widgets={'View': True}),
+        ],
+        'pages/03_Campaign_Comparison_Details.py': [
+            Interaction('two campaigns', state={'campaigns': campaigns[:2]}),
+            Interaction('all campaigns', state={'campaigns': campaigns}),
+            Interaction('normalized start', widgets={'Start Date Toggle': 'Normalized Start'}),
+            Interaction('weekly rolling mean', widgets={'Rolling Mean Toggle': 'Weekly LA Rolling Mean'}),
+            Interaction('monthly rolling mean', widgets={'Rolling Mean Toggle': 'Monthly LA Rolling Mean'}),
+        ],
+        'pages/04_Manual_Analysis.py': [
+            Interaction('last 30 days', state={'date_range': (end - datetime.timedelta(29), end)}),
+            Interaction('full range', state={'date_range': (synthetic.START_DATE.date(), end)}),
+            Interaction('top 10 countries', state={'countries': top_countries},
+                widgets={'Select All Countries': False}),
+            Interaction('daily reading activity', widgets={'View': True}),
+            Interaction('learner rows', widgets={'View': False, 'Fetch learner rows': True}),
+        ],
+    }
+
+class PageSession:
+    '''One browser session on one page: session state and widget values persist
+    across its reruns.'''
+    def __init__(self, page, timer):
+        self.path = os.path.join(ROOT_DIR, page)
+        self.sections = split_sections(self.path)
+        self.timer = timer
+        self.widgets = {}
+        self.message_bytes = 0
+        self.ctx = ScriptRunContext(
+            session_id=str(uuid.uuid4()),
+            _enqueue=self._enqueue,
+            query_string='',
+            session_state=SafeSessionState(SessionState()),
+            uploaded_file_mgr=UploadedFileManager(),
+            page_script_hash='',
+            user_info={'email': 'test@example.com'},
+        )
+
+    def _enqueue(self, msg):
+        self.message_bytes += msg.ByteSize()
+
+    def rerun(self, interaction):
+        """Runs the page once after applying interaction. Returns the per-section
+        timings, {'section', 'total_s', 'bytes', <category>_s}.
+        """
+        thread = threading.current_thread()
+        add_script_run_ctx(thread, self.ctx)
+        self.timer.thread = thread
+        self.ctx.reset()
+        for key, value in interaction.state.items():
+            self.ctx.session_state[key] = value
+        self.widgets.update(interaction.widgets)
+        _widget_values.clear()
+        _widget_values.update(self.widgets)
+        self.ctx.on_script_start()
+        namespace = {'__name__': '__main__', '__file__': self.path}
+        sections = []
+        try:
+            for name, code in self.sections:
+                self.timer.times.clear()
+                message_bytes = self.message_bytes
+                start = time.perf_counter()
+                # st.stop() ends the run quietly, as it does under streamlit run.
+                stopped = False
+                try:
+                    exec(code, namespace)
+                except StopException:
+                    stopped = True
+                total = time.perf_counter() - start
+                times = dict(self.timer.times)
+                times['transform'] = total - sum(times.values())
+                sections.append(dict({f'{category}_s': times.get(category, 0.0) for category in CATEGORIES},
+                    section=name, total_s=total, bytes=self.message_bytes - message_bytes))
+                if stopped:
+                    break
+        finally:
+            self.ctx.session_state.on_script_finished(self.ctx.widget_ids_this_run)
+            _widget_values.clear()
+        return sections
+
+def clear_caches():
+    st.experimental_memo.clear()
+    st.experimental_singleton.clear()
+    shutil.rmtree(CACHE_DIR, ignore_errors=True)
+
+def print_rerun(interaction, sections):
+    totals = {key: sum(section[key] for section in sections) for key in ['total_s', 'bytes']
+        + [f'{category}_s' for category in CATEGORIES]}
+    def format_times(times):
+        return '  '.join(f'{category} {times[f"{category}_s"] * 1000:8.1f}' for category in CATEGORIES)
+    print(f'  {interaction.name:28} total {totals["total_s"] * 1000:8.1f} ms  {format_times(totals)}'
+        f'  {totals["bytes"] / 1024:8.1f} KiB')
+    for section in sections:
+        print(f'    {section["section"][:26]:26} total {section["total_s"] * 1000:8.1f} ms  {format_times(section)}'
+            f'  {section["bytes"] / 1024:8.1f} KiB')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Render the dashboard pages offline and time every rerun.')
+    parser.add_argument('--rows', type=int, default=1000000, help='ftm_users size.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--pages', nargs='+', help='Run only the pages whose path contains one of these.')
+    parser.add_argument('--cold', action='store_true',
+        help='Clear the memo, singleton and disk caches before every rerun.')
+    parser.add_argument('--results', default=RESULTS_FILE)
+    args = parser.parse_args(argv)
+
+    sources = OfflineSources(args.rows, args.seed)
+    install_sources(sources)
+    timer = Timer()
+    install_timer(timer)
+    install_widget_values()
+    run = {
+        'run_id': datetime.datetime.now().isoformat(timespec='seconds'),
+        'git_rev': get_git_rev(),
+        'rows': args.rows,
+        'cold': args.cold,
+    }
+    records = []
+    failed = False
+    print(f'rows={args.rows:,} cube_rows={len(sources.cube):,}')
+    for page, interactions in get_interactions(sources).items():
+        if args.pages and not any(name in page for name in args.pages):
+            continue
+        print(page)
+        session = PageSession(page, timer)
+        for interaction in interactions:
+            if args.cold:
+                clear_caches()
+            try:
+                sections = session.rerun(interaction)
+            except Exception:
+                traceback.print_exc()
+                failed = True
+                break
+            print_rerun(interaction, sections)
+            records.append(dict(run, page=page, interaction=interaction.name,
+                total_s=sum(section['total_s'] for section in sections), sections=sections))
+    append_results(records, args.results)
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
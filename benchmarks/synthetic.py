@@ -0,0 +1,105 @@
+# synthetic.py
+# Offline stand-ins for the dashboard's data: ftm_users, its rollup cube and the
+# campaign, apps, campaign metrics and annual metrics sheets. The mixes are
+# skewed like production (a few large apps and countries, a long tail), LA grows
+# over the years and most learners stop within the first levels.
+import os
+import numpy as np
+import pandas as pd
+from ftm_metrics import build_country_dim
+
+COUNTRIES_CSV = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'countries.csv')
+LANGUAGES = ['english', 'spanish', 'french', 'portuguese', 'hindi', 'arabic',
+    'swahili', 'zulu', 'xhosa', 'amharic', 'bengali', 'urdu']
+START_DATE = pd.Timestamp('2021-01-01')
+N_DAYS = 3 * 365
+
+def _get_zipf_probs(n, s):
+    probs = 1 / np.arange(1, n + 1) ** s
+    return probs / probs.sum()
+
+def get_countries():
+    # Same frame as ftm_data.get_countries, so synthetic rows carry GA country names.
+    return build_country_dim(pd.read_csv(COUNTRIES_CSV, keep_default_na=False))
+
+def make_apps(seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'app_id': [f'org.curiouslearning.ftm_{language}' for language in LANGUAGES],
+        'language': LANGUAGES,
+        'bq_property_id': [str(300000000 + i) for i in range(len(LANGUAGES))],
+        'bq_project_id': [f'ftm-{language}' for language in LANGUAGES],
+        'total_lvls': rng.integers(60, 161, len(LANGUAGES)),
+    })
+
+def make_users(n_rows, apps, countries, seed=0):
+    """Returns n_rows synthetic ftm_users rows with the dtypes of ftm_data.set_user_dtypes
+    plus country_iso3. user_pseudo_id is left out, no computation reads it.
+    """
+    rng = np.random.default_rng(seed)
+    app_codes = rng.choice(len(apps), n_rows, p=_get_zipf_probs(len(apps), 1.2))
+    # A seeded shuffle decides which countries are the large ones.
+    country_order = rng.permutation(len(countries))
+    country_codes = country_order[rng.choice(len(countries), n_rows, p=_get_zipf_probs(len(countries), 1.1))]
+    # sqrt of a uniform skews LA towards the later years.
+    days = (N_DAYS * np.sqrt(rng.random(n_rows))).astype('int64')
+    total_lvls = apps['total_lvls'].to_numpy()[app_codes]
+    max_lvl = np.minimum(rng.geometric(0.08, n_rows), total_lvls)
+    la_date = START_DATE + pd.to_timedelta(days, unit='D')
+    max_lvl_date = la_date + pd.to_timedelta(np.minimum(rng.integers(0, 90, n_rows), N_DAYS - days), unit='D')
+    country = pd.Categorical.from_codes(country_codes, categories=countries['ga_name'])
+    return pd.DataFrame({
+        'LA_date': la_date,
+        'app_id': pd.Categorical.from_codes(app_codes, categories=apps['app_id']),
+        'country': country,
+        'max_lvl': max_lvl.astype('int16'),
+        'max_lvl_date': max_lvl_date,
+        'total_lvls_succeeded': (max_lvl + rng.poisson(max_lvl * 0.3)).astype('int32'),
+        'country_iso3': pd.Categorical.from_codes(country_codes, categories=countries['alpha3']),
+    })
+
+def make_cube(users):
+    # Same grain and la column as ftm_refresh.get_cube_sql.
+    keys = ['app_id', 'country', 'country_iso3', 'LA_date', 'max_lvl']
+    cube = users.groupby(keys, observed=True).size().reset_index(name='la')
+    return cube.astype({'la': 'int32'})
+
+def make_campaigns(apps, countries, n_campaigns=40, seed=0):
+    # Mostly single-country campaigns in the large countries, some 'All'.
+    rng = np.random.default_rng(seed)
+    languages = rng.choice(apps['language'], n_campaigns)
+    country_names = rng.choice(countries['ga_name'][:30], n_campaigns).astype(object)
+    country_names[rng.random(n_campaigns) < 0.2] = 'All'
+    start = START_DATE + pd.to_timedelta(rng.integers(0, N_DAYS - 180, n_campaigns), unit='D')
+    end = start + pd.to_timedelta(rng.integers(30, 180, n_campaigns), unit='D')
+    return pd.DataFrame({
+        'Campaign Name': [f'Campaign {i}' for i in range(n_campaigns)],
+        'Language': languages,
+        'Country': country_names,
+        'Start Date': start.date,
+        'End Date': end.date,
+        'Total Cost (USD)': rng.uniform(1000, 50000, n_campaigns).round(2),
+    })
+
+def make_campaign_metrics(campaigns, seed=0):
+    rng = np.random.default_rng(seed)
+    n = len(campaigns)
+    la = rng.integers(1000, 100000, n)
+    ra = rng.uniform(0.05, 0.4, n)
+    cost = campaigns['Total Cost (USD)'].to_numpy()
+    return pd.DataFrame({
+        'campaign_name': campaigns['Campaign Name'],
+        'la': la,
+        'lac': cost / la,
+        'ra': ra,
+        'rac': cost / (ra * la),
+    })
+
+def make_annual_metrics(seed=0):
+    rng = np.random.default_rng(seed)
+    years = np.arange(START_DATE.year, START_DATE.year + N_DAYS // 365)
+    return pd.DataFrame({
+        'year': years,
+        'la': rng.integers(100000, 2000000, len(years)),
+        'ra': rng.uniform(0.05, 0.4, len(years)),
+    })
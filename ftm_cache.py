@@ -0,0 +1,178 @@
+# ftm_cache.py
+# Persistent on-disk cache of loader results. DataFrames are stored as Parquet
+# files keyed by function and arguments, so a restarted server process starts
+# from disk instead of BigQuery or Sheets. Entries expire after their ttl and the
+# least recently used ones are evicted once the cache is over its size cap.
+# Loaders keyed on a source table version drop superseded versions on write.
+import os
+import time
+import types
+import hashlib
+import functools
+import threading
+import pandas as pd
+import pyarrow as pa
+from streamlit.runtime import Runtime
+from ftm_telemetry import record_io
+
+CACHE_DIR = os.environ.get('FTM_CACHE_DIR', os.path.join('.ftm_cache', 'results'))
+CACHE_MAX_BYTES = int(os.environ.get('FTM_CACHE_MAX_BYTES', 2 * 1024 ** 3))
+
+_lock = threading.Lock()
+
+def _get_digest(value):
+    return hashlib.sha1(repr(value).encode()).hexdigest()
+
+def get_cache_name(func):
+    return f'{func.__module__}.{func.__qualname__}'
+
+def _get_code_key(code):
+    # Bytecode alone does not change when only a constant does (e.g. a loader's
+    # SQL text), so constants and referenced names are included. Nested code
+    # objects are keyed the same way, as their repr holds a memory address.
+    consts = []
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            const = _get_code_key(const)
+        elif isinstance(const, frozenset):
+            const = sorted(map(repr, const))
+        consts.append(const)
+    return (code.co_code, consts, code.co_names)
+
+def get_cache_key(func, args, kwargs, versioned=False):
+    # The function's code is part of the key so a deploy that changes a loader
+    # doesn't read results written by the previous code.
+    code = _get_code_key(func.__code__)
+    if versioned:
+        # The version gets its own key segment so older versions can be found.
+        return f'{get_cache_name(func)}-v{_get_digest((args[0], code))[:12]}-{_get_digest((args[1:], sorted(kwargs.items())))}'
+    return f'{get_cache_name(func)}-{_get_digest((code, args, sorted(kwargs.items())))}'
+
+def get_entries(cache_dir=CACHE_DIR):
+    # (path, size, last access) of every cached result, least recently used
+    # first. The access time is set explicitly on every read (see _read), so
+    # this does not depend on the filesystem's atime mount options.
+    if not os.path.isdir(cache_dir):
+        return []
+    entries = []
+    for name in os.listdir(cache_dir):
+        if not name.endswith('.parquet'):
+            continue
+        path = os.path.join(cache_dir, name)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        entries.append((path, stat.st_size, stat.st_atime))
+    return sorted(entries, key=lambda entry: entry[2])
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def evict(max_bytes=CACHE_MAX_BYTES, cache_dir=CACHE_DIR):
+    entries = get_entries(cache_dir)
+    total = sum(size for _, size, _ in entries)
+    for path, size, _ in entries:
+        if total <= max_bytes:
+            break
+        _remove(path)
+        total -= size
+
+def evict_superseded(key, cache_dir=CACHE_DIR):
+    # Removes the entries of key's function that were stored for another version.
+    name, version, _ = key.split('-')
+    for path, _, _ in get_entries(cache_dir):
+        entry_name, entry_version = os.path.basename(path).split('-')[:2]
+        if entry_name == name and entry_version.startswith('v') and entry_version != version:
+            _remove(path)
+
+def get_cache_stats(cache_dir=CACHE_DIR):
+    # Entry count and size on disk per cached function.
+    entries = pd.DataFrame(get_entries(cache_dir), columns=['path', 'bytes', 'last_access'])
+    entries['cache'] = entries['path'].map(lambda path: os.path.basename(path).split('-')[0])
+    return entries.groupby('cache', as_index=False).agg(entries=('bytes', 'size'), bytes=('bytes', 'sum'))
+
+def get_memo_stats():
+    # Entry count and in-memory size of every st.experimental_memo and
+    # st.experimental_singleton cache in this server process. Scripts run
+    # outside `streamlit run` (e.g. benchmarks.render_pages) have no runtime.
+    stats = Runtime.instance().stats_mgr.get_stats() if Runtime.exists() else []
+    entries = pd.DataFrame([(stat.category_name, stat.cache_name, stat.byte_length) for stat in stats],
+        columns=['category', 'cache', 'bytes'])
+    return entries.groupby(['category', 'cache'], as_index=False).agg(entries=('bytes', 'size'), bytes=('bytes', 'sum'))
+
+def _read(path, ttl):
+    # mtime is when the entry was written, atime when it was last read. Expired
+    # entries stay on disk as stale fallbacks until rewritten or evicted.
+    try:
+        stat = os.stat(path)
+        if ttl is not None and time.time() - stat.st_mtime > ttl:
+            return None
+        df = pd.read_parquet(path)
+        os.utime(path, (time.time(), stat.st_mtime))
+    except FileNotFoundError:
+        return None
+    except pa.ArrowException:
+        _remove(path)
+        return None
+    return df
+
+def _write(df, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        df.to_parquet(tmp_path)
+    except (pa.ArrowException, ValueError, TypeError):
+        # Mixed-type object columns (e.g. free-form sheet cells) can't be stored
+        # as Parquet; the result is still returned, just not cached on disk.
+        _remove(tmp_path)
+        return
+    os.replace(tmp_path, path)
+
+def disk_cache(ttl=None, cache_dir=CACHE_DIR, max_bytes=CACHE_MAX_BYTES, versioned=False):
+    """Caches a loader's DataFrame result on disk. Put it under @st.experimental_memo
+    so the in-memory cache is checked first and disk is only read on a cold process.
+    :param ttl: Seconds after which an entry is reloaded, None to keep it until evicted.
+    :param cache_dir: Directory holding the Parquet files.
+    :param max_bytes: Total size of cache_dir above which LRU entries are evicted.
+    :param versioned: The first argument is the source table version (see
+        ftm_data.get_table_version); entries of other versions are dropped on write.
+    The wrapper's read_stale(*args, **kwargs) returns the nearest entry regardless
+    of ttl and version, or None.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = get_cache_key(func, args, kwargs, versioned)
+            path = os.path.join(cache_dir, f'{key}.parquet')
+            df = _read(path, ttl)
+            record_io(disk='miss' if df is None else 'hit')
+            if df is not None:
+                return df
+            df = func(*args, **kwargs)
+            with _lock:
+                _write(df, path)
+                if versioned:
+                    evict_superseded(key, cache_dir)
+                evict(max_bytes, cache_dir)
+            return df
+        def read_stale(*args, **kwargs):
+            # The entry for these arguments even if expired or, for versioned
+            # loaders, the most recently used one of another version.
+            key = get_cache_key(func, args, kwargs, versioned)
+            df = _read(os.path.join(cache_dir, f'{key}.parquet'), None)
+            if df is None and versioned:
+                name, _, rest = key.split('-')
+                for path, _, _ in reversed(get_entries(cache_dir)):
+                    entry_name, _, entry_rest = os.path.basename(path)[:-len('.parquet')].split('-')
+                    if entry_name == name and entry_rest == rest:
+                        df = _read(path, None)
+                        if df is not None:
+                            break
+            return df
+        wrapper.read_stale = read_stale
+        return wrapper
+    return decorator
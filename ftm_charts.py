@@ -0,0 +1,72 @@
+# ftm_charts.py
+# Plotly figures shared by the dashboard pages.
+import plotly.express as px
+from ftm_metrics import get_month_ticks, downsample_series
+
+# Cap on points per series for long time charts; the callers opt in by passing
+# it as max_points, the series are then thinned with LTTB.
+LA_MAX_POINTS = 500
+
+def update_normalized_xaxes(fig, daily_la):
+    # daily_la['LA_date'] holds the day index from get_normalized_start_df, so
+    # the month ticks follow the longest selected campaign.
+    tickvals, ticktext = get_month_ticks(daily_la['LA_date'])
+    fig.update_xaxes(
+        tickmode='array',
+        tickvals=tickvals,
+        ticktext=ticktext
+    )
+    fig.update_layout(
+        xaxis_title='Date (Month)'
+    )
+
+def get_la_fig(daily_la, y, norm, title, max_points=None):
+    # daily_la comes from get_rolling_la, so y only selects a precomputed column.
+    if max_points is not None:
+        daily_la = downsample_series(daily_la, 'LA_date', y, 'campaign', max_points)
+    la_fig = px.line(daily_la,
+        x='LA_date',
+        y=y,
+        color='campaign',
+        labels={'LA_date': 'Day' if norm else 'Date',
+            'campaign': 'Campaign',
+            y: 'LA'},
+        title=title)
+    if norm == True:
+        update_normalized_xaxes(la_fig, daily_la)
+    return la_fig
+
+def get_daily_la_fig(daily_la, norm, max_points=None):
+    return get_la_fig(daily_la, 'LA', norm, 'Daily LA', max_points)
+
+def get_weekly_la_fig(daily_la, norm, max_points=None):
+    return get_la_fig(daily_la, 'Weekly Rolling Mean', norm, 'Weekly LA', max_points)
+
+def get_monthly_la_fig(daily_la, norm, max_points=None):
+    return get_la_fig(daily_la, 'Monthly Rolling Mean', norm, 'Monthly LA', max_points)
+
+def get_daily_la_rm_fig(daily_la, max_points=None):
+    # Daily LA of a single selection with its 7 and 30 day rolling means overlaid.
+    rm_columns = ['7 Day Rolling Mean', '30 Day Rolling Mean']
+    la = daily_la
+    rm_la = daily_la.melt(id_vars='LA_date', value_vars=rm_columns)
+    if max_points is not None:
+        la = downsample_series(la, 'LA_date', 'Learners Acquired', max_points=max_points)
+        rm_la = downsample_series(rm_la, 'LA_date', 'value', 'variable', max_points)
+    daily_la_fig = px.line(la,
+        x='LA_date',
+        y='Learners Acquired',
+        labels={"LA_date": "Date",
+            'Learners Acquired': 'LA'},
+        title="Daily LA")
+    rm_fig = px.line(rm_la,
+        x='LA_date',
+        y='value',
+        color='variable',
+        color_discrete_map={
+            '7 Day Rolling Mean': 'green',
+            '30 Day Rolling Mean': 'red'
+        })
+    for trace in rm_fig.data:
+        daily_la_fig.add_trace(trace)
+    return daily_la_fig
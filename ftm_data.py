@@ -0,0 +1,577 @@
+# ftm_data.py
+# Shared data access for every page. Credentials, the BigQuery client and the
+# Google Sheets connections are built once per server process and shared by all
+# sessions, so a rerun only pays for the loaders it actually calls.
+import os
+import re
+import time
+import queue
+import threading
+import functools
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError, as_completed
+from typing import NamedTuple
+import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+import requests
+from google.oauth2 import service_account
+from google.auth.transport.requests import AuthorizedSession
+from google.api_core.exceptions import BadRequest
+from google.cloud import bigquery
+from google.cloud import bigquery_storage
+from gsheetsdb import connect
+import pandas as pd
+import db_dtypes
+from ftm_cache import disk_cache
+from ftm_telemetry import traced, phase, record_io
+from ftm_queries import get_aggregate_sql
+from ftm_metrics import build_campaign_index, build_country_dim, get_rolling_la
+
+SHEETS_POOL_SIZE = 4
+# Rows per page when results come back over the REST API instead of the
+# Storage Read API (e.g. small or cached results).
+BQ_PAGE_SIZE = 100000
+# BigQuery jobs a page runs concurrently (see start_loads).
+BQ_MAX_WORKERS = 4
+# Default per-job limits of a page's BigQuery jobs (see set_query_budget).
+BQ_MAX_BYTES_BILLED = int(os.environ.get('FTM_BQ_MAX_BYTES_BILLED', 20 * 1024 ** 3))
+BQ_TIMEOUT = float(os.environ.get('FTM_BQ_TIMEOUT', 120))
+# Seconds a loader result is kept in the on-disk cache (see ftm_cache). Sheets
+# are keyed on their revision instead, this is only the fallback.
+SHEETS_CACHE_TTL = 60 * 60
+# Seconds between checks of a sheet's Drive revision.
+SHEET_REVISION_TTL = 60
+DRIVE_FILES_URL = 'https://www.googleapis.com/drive/v3/files'
+# Seconds between checks of a source table's last-modified time.
+TABLE_VERSION_TTL = 10 * 60
+# Tables refreshed nightly by ftm_refresh. Their loaders take the table's
+# version (see get_table_version) as their first argument.
+FTM_USERS_TABLE = 'dataexploration-193817.user_data.ftm_users'
+FTM_USERS_CUBE_TABLE = 'dataexploration-193817.user_data.ftm_users_cube'
+FTM_DAILY_ACTIVITY_TABLE = 'dataexploration-193817.user_data.ftm_daily_activity'
+COUNTRIES_CSV = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'countries.csv')
+
+class QueryBudgetExceeded(Exception):
+    '''A BigQuery job was refused or stopped by the page's query budget.'''
+
+class QueryBudget(NamedTuple):
+    max_bytes_billed: int
+    timeout: float
+
+class ConnectionPool:
+    '''Bounded, thread-safe pool of connections created lazily by factory.'''
+    def __init__(self, factory, size):
+        self._factory = factory
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._slots = threading.BoundedSemaphore(size)
+
+    @contextmanager
+    def connection(self):
+        self._slots.acquire()
+        try:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = self._factory()
+            # A connection that raised is dropped rather than handed out again.
+            yield conn
+            self._idle.put_nowait(conn)
+        finally:
+            self._slots.release()
+
+# --- CLIENTS ---
+@st.experimental_singleton
+def get_sheets_pool():
+    credentials = service_account.Credentials.from_service_account_info(
+        st.secrets["gcp_service_account"],
+        scopes=[
+            "https://www.googleapis.com/auth/spreadsheets",
+        ]
+    )
+    return ConnectionPool(lambda: connect(credentials=credentials), SHEETS_POOL_SIZE)
+
+@st.experimental_singleton
+def get_drive_session():
+    # Only used for sheet metadata (see get_sheet_revision).
+    credentials = service_account.Credentials.from_service_account_info(
+        st.secrets["gcp_service_account"],
+        scopes=[
+            "https://www.googleapis.com/auth/drive.metadata.readonly",
+        ]
+    )
+    return AuthorizedSession(credentials)
+
+@st.experimental_singleton
+def get_bq_client():
+    # bigquery.Client is thread-safe and keeps its own HTTP connection pool,
+    # so one instance serves every session in the process.
+    bq_credentials = service_account.Credentials.from_service_account_info(
+        st.secrets["gcp_service_account"]
+    )
+    return bigquery.Client(credentials=bq_credentials)
+
+@st.experimental_singleton
+def get_bqstorage_client():
+    bq_credentials = service_account.Credentials.from_service_account_info(
+        st.secrets["gcp_service_account"]
+    )
+    return bigquery_storage.BigQueryReadClient(credentials=bq_credentials)
+
+def run_concurrently(func, items, max_workers):
+    # Yields (item, func(item)) as each call finishes. Worker threads share the
+    # session's script context so memoized loaders work in them.
+    ctx = get_script_run_ctx()
+    def call(item):
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return item, func(item)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(call, item) for item in items]
+        try:
+            for future in as_completed(futures):
+                yield future.result()
+        finally:
+            # A rerun stops the page mid-iteration; don't start calls nobody reads.
+            for future in futures:
+                future.cancel()
+
+def start_loads(loads, max_workers=BQ_MAX_WORKERS):
+    """Starts every load in a worker thread right away, so the page can render
+    what it already has (e.g. sheet metrics and placeholders) while they run.
+    Returns name -> Future. Loaders run this way need show_spinner=False, a
+    spinner started from a worker would land anywhere on the page.
+    :param loads: name -> callable without arguments, e.g. a functools.partial of a loader.
+    """
+    ctx = get_script_run_ctx()
+    def call(load):
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return load()
+    pool = ThreadPoolExecutor(max_workers=max_workers)
+    futures = {name: pool.submit(call, load) for name, load in loads.items()}
+    # The workers exit once their loads are done; nothing waits for them here.
+    pool.shutdown(wait=False)
+    return futures
+
+def iter_loaded(futures):
+    # Yields (name, future) of start_loads' futures as each one finishes.
+    names = {future: name for name, future in futures.items()}
+    try:
+        for future in as_completed(names):
+            yield names[future], future
+    finally:
+        for future in names:
+            future.cancel()
+
+def run_query(query):
+    with get_sheets_pool().connection() as conn:
+        with phase('wait'):
+            rows = conn.execute(query, headers=1)
+        with phase('fetch'):
+            rows = rows.fetchall()
+    record_io(queries=1, rows=len(rows))
+    return rows
+
+def set_query_budget(max_bytes_billed=BQ_MAX_BYTES_BILLED, timeout=BQ_TIMEOUT):
+    """Sets the limits of every BigQuery job the calling page starts in this session.
+    :param max_bytes_billed: Bytes a single job may scan; larger jobs are refused after a dry run.
+    :param timeout: Seconds a job may run before it is cancelled.
+    """
+    ctx = get_script_run_ctx()
+    st.session_state[f'query_budget-{ctx.page_script_hash}'] = QueryBudget(max_bytes_billed, timeout)
+
+def get_query_budget():
+    # Loader threads share the page's script context (see run_concurrently).
+    ctx = get_script_run_ctx()
+    default = QueryBudget(BQ_MAX_BYTES_BILLED, BQ_TIMEOUT)
+    if ctx is None:
+        return default
+    return st.session_state.get(f'query_budget-{ctx.page_script_hash}', default)
+
+def query_df(sql_query, job_config=None, page_size=BQ_PAGE_SIZE):
+    # Results are streamed as Arrow record batches (over the Storage Read API
+    # when available) and assembled into a typed DataFrame without building
+    # a Python object per row. Every job is dry-run first and refused if it
+    # would scan more than the page's budget; maximum_bytes_billed enforces
+    # the same limit on BigQuery's side.
+    budget = get_query_budget()
+    job_config = job_config or bigquery.QueryJobConfig()
+    with phase('submit'):
+        dry_run = get_bq_client().query(sql_query, job_config = bigquery.QueryJobConfig(
+            dry_run=True, query_parameters=job_config.query_parameters))
+    record_io(estimated_bytes=dry_run.total_bytes_processed)
+    if (dry_run.total_bytes_processed or 0) > budget.max_bytes_billed:
+        raise QueryBudgetExceeded(f'the query would scan {dry_run.total_bytes_processed / 1024 ** 3:.1f} GiB, '
+            f'over the page budget of {budget.max_bytes_billed / 1024 ** 3:.1f} GiB')
+    job_config.maximum_bytes_billed = budget.max_bytes_billed
+    with phase('submit'):
+        job = get_bq_client().query(sql_query, job_config = job_config)
+    with phase('wait'):
+        try:
+            rows = job.result(page_size=page_size, timeout=budget.timeout)
+        except (FutureTimeoutError, requests.Timeout) as e:
+            job.cancel()
+            raise QueryBudgetExceeded(f'the query ran longer than the page timeout of {budget.timeout:.0f} s') from e
+        except BadRequest as e:
+            if any(error.get('reason') == 'bytesBilledLimitExceeded' for error in e.errors):
+                raise QueryBudgetExceeded(f'the query billed more than the page budget of '
+                    f'{budget.max_bytes_billed / 1024 ** 3:.1f} GiB') from e
+            raise
+    with phase('fetch'):
+        table = rows.to_arrow(bqstorage_client=get_bqstorage_client())
+    with phase('convert'):
+        df = table.to_pandas()
+    record_io(queries=1, rows=table.num_rows, bytes=table.nbytes,
+        bytes_processed=job.total_bytes_processed, cache_hit=job.cache_hit, job_id=job.job_id)
+    return df
+
+@st.experimental_memo
+def get_countries():
+    return build_country_dim(pd.read_csv(COUNTRIES_CSV, keep_default_na=False))
+
+def set_country_codes(df):
+    # Adds country_iso3, the ISO-3 code of each row's GA country name, as a
+    # categorical; names outside the dimension (e.g. '(not set)') map to NaN.
+    iso3 = get_countries().set_index('ga_name')['alpha3']
+    return df.assign(country_iso3=df['country'].astype(str).map(iso3).astype('category'))
+
+def set_user_dtypes(df):
+    # Compact ftm_users schema: low-cardinality strings as categoricals, small
+    # ints for levels and native datetime64 dates so date masks stay vectorized.
+    # user_pseudo_id is unique per row, so it is kept as an Arrow-backed string
+    # (one contiguous buffer) rather than a dictionary that would not dedupe.
+    return df.astype({
+        'user_pseudo_id': 'string[pyarrow]',
+        'app_id': 'category',
+        'country': 'category',
+        'max_lvl': 'int16',
+        'total_lvls_succeeded': 'int32',
+    }).assign(
+        LA_date=pd.to_datetime(df['LA_date']),
+        max_lvl_date=pd.to_datetime(df['max_lvl_date'])
+    )
+
+# --- SHEETS ---
+def get_sheet_id(sheet_url):
+    match = re.search(r'/spreadsheets/d/([\w-]+)', sheet_url)
+    return match.group(1) if match else None
+
+@traced('drive')
+@st.experimental_memo(ttl=SHEET_REVISION_TTL, show_spinner=False)
+def get_sheet_revision(sheet_url):
+    # Drive bumps a file's version on every edit, so the sheet loaders below,
+    # keyed on it, only download a sheet again after it changed. If the
+    # metadata can't be read the revision falls back to a SHEETS_CACHE_TTL bucket.
+    sheet_id = get_sheet_id(sheet_url)
+    if sheet_id is not None:
+        try:
+            with phase('wait'):
+                response = get_drive_session().get(f'{DRIVE_FILES_URL}/{sheet_id}',
+                    params={'fields': 'version', 'supportsAllDrives': 'true'}, timeout=10)
+            response.raise_for_status()
+            return response.json()['version']
+        except (requests.RequestException, KeyError, ValueError):
+            pass
+    return f'ttl-{int(time.time() // SHEETS_CACHE_TTL)}'
+
+@traced('sheets')
+@st.experimental_memo(max_entries=1, show_spinner=False)
+@disk_cache(versioned=True)
+def load_campaign_data(revision, sheet_url):
+    campaign_rows = run_query(f'SELECT * FROM "{sheet_url}"')
+    campaign_data = pd.DataFrame(columns = ['Campaign Name', 'Language', 'Country', 'Start Date', 'End Date', 'Total Cost (USD)'],
+                            data = campaign_rows)
+    campaign_data['Start Date'] = (pd.to_datetime(campaign_data['Start Date'])).dt.date
+    campaign_data['End Date'] = (pd.to_datetime(campaign_data['End Date'])
+                                    + pd.DateOffset(months=1) - pd.Timedelta(1, unit='D')).dt.date
+    campaign_data = campaign_data.astype({
+        'Total Cost (USD)': 'float'
+    })
+    return campaign_data
+
+@traced('sheets')
+@st.experimental_memo(max_entries=1, show_spinner=False)
+@disk_cache(versioned=True)
+def load_annual_campaign_data(revision, sheet_url):
+    ann_camp_rows = run_query(f'''
+        SELECT * FROM "{sheet_url}"
+    ''')
+    ann_camp_data = pd.DataFrame(columns = ['year', 'la', 'ra'],
+                            data = ann_camp_rows)
+    ann_camp_data = ann_camp_data.astype({
+        'year': 'int',
+    })
+    return ann_camp_data
+
+@traced('sheets')
+@st.experimental_memo(max_entries=1, show_spinner=False)
+@disk_cache(versioned=True)
+def load_apps_data(revision, sheet_url):
+    apps_rows = run_query(f'SELECT app_id, language, bq_property_id, bq_project_id, total_lvls FROM "{sheet_url}"')
+    apps_data = pd.DataFrame(columns = ['app_id', 'language', 'bq_property_id', 'bq_project_id', 'total_lvls'],
+        data = apps_rows)
+    return apps_data
+
+@traced('sheets')
+@st.experimental_memo(max_entries=1, show_spinner=False)
+@disk_cache(versioned=True)
+def load_campaign_metrics(revision, sheet_url):
+    camp_metrics_rows = run_query(f'SELECT * FROM "{sheet_url}"')
+    camp_metrics_data = pd.DataFrame(columns = ['campaign_name', 'la', 'lac', 'ra', 'rac'],
+                            data = camp_metrics_rows)
+    camp_metrics_data = camp_metrics_data.astype({
+        'la': 'int',
+        'lac': 'float',
+        'ra': 'float',
+        'rac': 'float'
+    })
+    return camp_metrics_data
+
+# Sheet name -> (secret holding its URL, loader).
+SHEETS = {
+    'campaigns': ('Campaign_gsheets_url', load_campaign_data),
+    'annual_campaigns': ('ann_camp_metrics_gsheets_url', load_annual_campaign_data),
+    'apps': ('ftm_apps_gsheets_url', load_apps_data),
+    'campaign_metrics': ('campaign_metrics_gsheets_url', load_campaign_metrics),
+}
+
+def get_sheets(*names):
+    """Returns the typed frames of the named sheets (see SHEETS), in order. The
+    revision checks and any downloads of changed sheets run concurrently.
+    """
+    def load(name):
+        secret, loader = SHEETS[name]
+        sheet_url = st.secrets[secret]
+        return loader(get_sheet_revision(sheet_url), sheet_url)
+    results = dict(run_concurrently(load, names, SHEETS_POOL_SIZE))
+    return [results[name] for name in names]
+
+# --- BIGQUERY ---
+def fallback_to_cache(func):
+    # Put above the @st.experimental_memo of a disk-cached loader. When the page's
+    # query budget refuses or stops its query, the loader's nearest cached
+    # result (expired, or of an older table version) is served instead, with
+    # the reason in df.attrs['stale'] (see show_stale_badge). Not memoized, so
+    # the next rerun tries the query again.
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except QueryBudgetExceeded as e:
+            df = func.read_stale(*args, **kwargs)
+            if df is None:
+                raise
+            df.attrs['stale'] = str(e)
+            record_io(stale=str(e))
+            return df
+    return wrapper
+
+def show_stale_badge(df, container=st):
+    if 'stale' in df.attrs:
+        container.warning(f'Approximate/stale: showing the last cached result because {df.attrs["stale"]}.')
+
+@traced('bigquery')
+@st.experimental_memo(ttl=TABLE_VERSION_TTL, show_spinner=False)
+def get_table_version(table_id):
+    # Last-modified time of a table. Loaders of nightly-refreshed tables take it
+    # as their first argument, so their cache entries turn over when the table
+    # actually changes and max_entries=1 drops the superseded generation.
+    with phase('wait'):
+        table = get_bq_client().get_table(table_id)
+    return table.modified.isoformat()
+
+def set_cube_dtypes(df):
+    return df.astype({
+        'app_id': 'category',
+        'country': 'category',
+        'max_lvl': 'int16',
+        'la': 'int32',
+    }).assign(
+        LA_date=pd.to_datetime(df['LA_date'])
+    )
+
+@traced('bigquery')
+@fallback_to_cache
+@st.experimental_memo(max_entries=1, show_spinner=False)
+@disk_cache(versioned=True)
+def get_user_cube(version):
+    # (app_id, country, LA_date, max_lvl) rollup of ftm_users kept by ftm_refresh.
+    sql_query = f"""
+        SELECT * FROM `{FTM_USERS_CUBE_TABLE}`
+    """
+    df = query_df(sql_query)
+    return set_country_codes(set_cube_dtypes(df))
+
+@st.experimental_memo(max_entries=1)
+def _get_campaign_index(version):
+    return build_campaign_index(get_user_cube(version))
+
+def get_campaign_index(version):
+    # A stale cube (see fallback_to_cache) is indexed on every call rather than
+    # memoized under a version whose cube it isn't.
+    cube = get_user_cube(version)
+    if 'stale' in cube.attrs:
+        return build_campaign_index(cube)
+    return _get_campaign_index(version)
+
+def get_date_params(start_date, end_date):
+    # The refreshed tables are partitioned on the DATE LA_date (see ftm_refresh),
+    # so the range is passed as DATEs for BigQuery to prune partitions with.
+    return [
+        bigquery.ScalarQueryParameter("start", "DATE", pd.Timestamp(start_date).date()),
+        bigquery.ScalarQueryParameter("end", "DATE", pd.Timestamp(end_date).date()),
+    ]
+
+@traced('bigquery')
+@fallback_to_cache
+@st.experimental_memo(max_entries=64, show_spinner=False)
+@disk_cache(versioned=True)
+def get_cube_aggregate(version, start_date, end_date, apps, countries=None, by=(), measures=('la',)):
+    # Aggregated ftm_users_cube rows (see ftm_queries.get_aggregate_sql) of the
+    # apps and GA country names; countries=None drops the country predicate.
+    sql_query = get_aggregate_sql(FTM_USERS_CUBE_TABLE, measures, by, countries is not None)
+    query_parameters = [
+        *get_date_params(start_date, end_date),
+        bigquery.ArrayQueryParameter("apps", "STRING", apps),
+    ]
+    if countries is not None:
+        query_parameters.append(bigquery.ArrayQueryParameter("countries", "STRING", countries))
+    job_config = bigquery.QueryJobConfig(
+        query_parameters = query_parameters
+    )
+    df = query_df(sql_query, job_config)
+    if 'LA_date' in by:
+        df['LA_date'] = pd.to_datetime(df['LA_date'])
+    if 'country' in by:
+        df = set_country_codes(df)
+    return df
+
+@traced('bigquery')
+@fallback_to_cache
+@st.experimental_memo(max_entries=64, show_spinner=False)
+@disk_cache(versioned=True)
+def get_campaign_user_data(version, start_date, end_date, app, country):
+    if country == 'All':
+        sql_query = f"""
+            SELECT * FROM `{FTM_USERS_TABLE}`
+            WHERE LA_date BETWEEN @start AND @end
+            AND app_id = @app
+        """
+    else:
+        sql_query = f"""
+            SELECT * FROM `{FTM_USERS_TABLE}`
+            WHERE LA_date BETWEEN @start AND @end
+            AND app_id = @app
+            AND country = @country
+        """
+    query_parameters = [
+        *get_date_params(start_date, end_date),
+        bigquery.ScalarQueryParameter("app", "STRING", app),
+        bigquery.ScalarQueryParameter("country", "STRING", country),
+    ]
+    job_config = bigquery.QueryJobConfig(
+        query_parameters = query_parameters
+    )
+    df = query_df(sql_query, job_config)
+    return set_country_codes(set_user_dtypes(df))
+
+@traced('bigquery')
+@fallback_to_cache
+@st.experimental_memo(max_entries=64)
+@disk_cache(versioned=True)
+def get_filtered_user_data(version, start_date, end_date, apps, countries=None):
+    # countries=None (every country selected) drops the country predicate.
+    country_filter = '' if countries is None else 'AND country IN UNNEST(@countries)'
+    sql_query = f"""
+        SELECT * FROM `{FTM_USERS_TABLE}`
+        WHERE LA_date BETWEEN @start AND @end
+        AND app_id IN UNNEST(@apps)
+        {country_filter}
+    """
+    query_parameters = [
+        *get_date_params(start_date, end_date),
+        bigquery.ArrayQueryParameter("apps", "STRING", apps),
+    ]
+    if countries is not None:
+        query_parameters.append(bigquery.ArrayQueryParameter("countries", "STRING", countries))
+    job_config = bigquery.QueryJobConfig(
+        query_parameters = query_parameters
+    )
+    df = query_df(sql_query, job_config)
+    return set_country_codes(set_user_dtypes(df))
+
+@traced('bigquery')
+@fallback_to_cache
+@st.experimental_memo(max_entries=64, show_spinner=False)
+@disk_cache(versioned=True)
+def get_campaign_daily_activity(version, start_date, end_date, app, country):
+    # Levels played per day by the campaign's cohort, read from the
+    # ftm_daily_activity table kept by ftm_refresh.
+    if country == 'All':
+        sql_query = f"""
+            SELECT event_date, SUM(levels_played) AS levels_played
+            FROM `{FTM_DAILY_ACTIVITY_TABLE}`
+            WHERE LA_date BETWEEN @start AND @end
+            AND event_date >= @start
+            AND app_id = @app
+            GROUP BY event_date
+            ORDER BY event_date
+        """
+    else:
+        sql_query = f"""
+            SELECT event_date, SUM(levels_played) AS levels_played
+            FROM `{FTM_DAILY_ACTIVITY_TABLE}`
+            WHERE LA_date BETWEEN @start AND @end
+            AND event_date >= @start
+            AND app_id = @app
+            AND country = @country
+            GROUP BY event_date
+            ORDER BY event_date
+        """
+    query_parameters = [
+        *get_date_params(start_date, end_date),
+        bigquery.ScalarQueryParameter("app", "STRING", app),
+        bigquery.ScalarQueryParameter("country", "STRING", country),
+    ]
+    job_config = bigquery.QueryJobConfig(
+        query_parameters = query_parameters
+    )
+    df = query_df(sql_query, job_config)
+    df['event_date'] = pd.to_datetime(df['event_date'])
+    return df
+
+@traced('bigquery')
+@fallback_to_cache
+@st.experimental_memo(max_entries=64)
+@disk_cache(versioned=True)
+def get_filtered_daily_activity(version, start_date, end_date, apps, countries=None):
+    # Levels played per day by the cohorts of every selected app in one job;
+    # ftm_daily_activity is small and pre-aggregated, so one scan beats a job
+    # (and a dry run) per app. countries=None drops the country predicate.
+    country_filter = '' if countries is None else 'AND country IN UNNEST(@countries)'
+    sql_query = f"""
+        SELECT event_date, SUM(levels_played) AS levels_played
+        FROM `{FTM_DAILY_ACTIVITY_TABLE}`
+        WHERE LA_date BETWEEN @start AND @end
+        AND event_date >= @start
+        AND app_id IN UNNEST(@apps)
+        {country_filter}
+        GROUP BY event_date
+        ORDER BY event_date
+    """
+    query_parameters = [
+        *get_date_params(start_date, end_date),
+        bigquery.ArrayQueryParameter("apps", "STRING", apps),
+    ]
+    if countries is not None:
+        query_parameters.append(bigquery.ArrayQueryParameter("countries", "STRING", countries))
+    job_config = bigquery.QueryJobConfig(
+        query_parameters = query_parameters
+    )
+    df = query_df(sql_query, job_config)
+    df['event_date'] = pd.to_datetime(df['event_date'])
+    return df
+
+@st.experimental_memo(max_entries=16)
+def get_la_series(daily_la):
+    # Daily LA plus its per-campaign rolling means, memoized on daily_la's
+    # content so the rolling-mean toggle reruns without recomputing them.
+    return get_rolling_la(daily_la)
@@ -0,0 +1,60 @@
+# ftm_diagnostics.py
+# Diagnostics view of the loader telemetry (ftm_telemetry) and the caches. It has
+# no page of its own: Summary.py renders it instead of the summary when opened
+# as /?diagnostics=<key>, where key is the diagnostics_key secret.
+import streamlit as st
+from ftm_telemetry import PHASES, get_records
+from ftm_cache import get_memo_stats, get_cache_stats
+
+RECENT_CALLS = 200
+
+def show_diagnostics():
+    key = st.secrets.get('diagnostics_key')
+    return key is not None and key in st.experimental_get_query_params().get('diagnostics', [])
+
+def get_loader_summary(records):
+    # Calls, memo and disk hit rates and time per phase for each page and loader.
+    records = records.assign(
+        page=records['page'].fillna('(unknown)'),
+        memo_hit=records['memo'] == 'hit',
+        disk_hit=records['disk'] == 'hit',
+    )
+    agg = {
+        'calls': ('loader', 'size'),
+        'memo_hit_rate': ('memo_hit', 'mean'),
+        'disk_hits': ('disk_hit', 'sum'),
+        'median_s': ('duration_s', 'median'),
+        'max_s': ('duration_s', 'max'),
+    }
+    agg.update({f'{name}_s': (f'{name}_s', 'sum') for name in PHASES + ['other']})
+    agg.update({
+        'rows': ('rows', 'sum'),
+        'estimated_bytes': ('estimated_bytes', 'sum'),
+        'bytes_processed': ('bytes_processed', 'sum'),
+        'stale': ('stale', 'count'),
+        'errors': ('error', 'count'),
+    })
+    return records.groupby(['page', 'loader'], as_index=False).agg(**agg)
+
+def render_diagnostics():
+    st.title('Diagnostics')
+    records = get_records()
+    if records.empty:
+        st.info('No loader calls recorded in this server process yet.')
+    else:
+        pages = sorted(records['page'].fillna('(unknown)').unique())
+        select_pages = st.multiselect('Pages', pages, pages)
+        records = records[records['page'].fillna('(unknown)').isin(select_pages)]
+        sessions = records['session_id'].dropna().unique().tolist()
+        select_session = st.selectbox('Session', ['All'] + sessions)
+        if select_session != 'All':
+            records = records[records['session_id'] == select_session]
+        st.subheader('Loaders')
+        st.dataframe(get_loader_summary(records))
+        st.subheader('Recent calls')
+        st.dataframe(records.tail(RECENT_CALLS).iloc[::-1].reset_index(drop=True))
+    st.subheader('Cache Status')
+    st.markdown('In memory')
+    st.dataframe(get_memo_stats())
+    st.markdown('On disk')
+    st.dataframe(get_cache_stats())
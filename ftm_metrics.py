@@ -0,0 +1,245 @@
+# ftm_metrics.py
+# Vectorized metric computations shared by the dashboard pages. Nothing in here
+# talks to BigQuery or Sheets; every function takes frames from ftm_data.
+import numpy as np
+import pandas as pd
+
+# Upper edge of each RA decile. A learner that completed 55% of the levels
+# falls in the 0.6 bucket, 90% and above (or unknown) falls in the 1 bucket.
+RA_DECILES = np.array([.1, .2, .3, .4, .5, .6, .7, .8, .9, 1])
+# Windows of the LA charts' rolling-mean toggle.
+LA_ROLLING_WINDOWS = {'Weekly': 7, 'Monthly': 30}
+
+# GA4 geo.country names that differ from the ISO names in countries.csv.
+GA_COUNTRY_NAMES = {
+    'bol': 'Bolivia',
+    'brn': 'Brunei',
+    'cpv': 'Cape Verde',
+    'cod': 'Congo - Kinshasa',
+    'cog': 'Congo - Brazzaville',
+    'civ': 'Côte d’Ivoire',
+    'irn': 'Iran',
+    'prk': 'North Korea',
+    'kor': 'South Korea',
+    'lao': 'Laos',
+    'fsm': 'Micronesia',
+    'mda': 'Moldova',
+    'mmr': 'Myanmar (Burma)',
+    'rus': 'Russia',
+    'stp': 'São Tomé & Príncipe',
+    'syr': 'Syria',
+    'tza': 'Tanzania',
+    'tur': 'Turkey',
+    'gbr': 'United Kingdom',
+    'usa': 'United States',
+    'ven': 'Venezuela',
+    'vnm': 'Vietnam',
+    'atg': 'Antigua & Barbuda',
+    'bih': 'Bosnia & Herzegovina',
+    'kna': 'St. Kitts & Nevis',
+    'lca': 'St. Lucia',
+    'vct': 'St. Vincent & Grenadines',
+    'tto': 'Trinidad & Tobago',
+    'pse': 'Palestine',
+    'twn': 'Taiwan',
+    'vat': 'Vatican City',
+    'vir': 'U.S. Virgin Islands',
+    'vgb': 'British Virgin Islands',
+    'tca': 'Turks & Caicos Islands',
+    'sxm': 'Sint Maarten',
+    'spm': 'St. Pierre & Miquelon',
+    'flk': 'Falkland Islands (Islas Malvinas)',
+    'bes': 'Caribbean Netherlands',
+    'wlf': 'Wallis & Futuna',
+    'shn': 'St. Helena',
+    'maf': 'St. Martin',
+    'blm': 'St. Barthélemy',
+}
+
+def get_ra_deciles(ra):
+    return RA_DECILES[np.digitize(ra, RA_DECILES[:-1])]
+
+def get_ra_segments(user_data, total_lvls, by=None, costs=None, weights=None):
+    """Returns LA, % LA, mean RA and (optionally) RAC per RA decile.
+    :param user_data: Learner (or rollup cube) rows with a max_lvl column. It is not modified.
+    :param total_lvls: Total FTM levels, either a scalar or one value per row.
+    :param by: Optional column of user_data (e.g. 'campaign') to split the deciles by.
+    :param costs: Total spend (USD), a scalar or a Series indexed by the by column.
+    :param weights: Optional column with the learner count of each row, e.g. 'la' for the cube.
+    """
+    ra = user_data['max_lvl'].to_numpy(dtype='float64') / np.asarray(total_lvls, dtype='float64')
+    la = np.ones(len(ra)) if weights is None else user_data[weights].to_numpy(dtype='float64')
+    # Learners with an unknown level count towards LA but not towards mean RA.
+    segs = pd.DataFrame({'seg': get_ra_deciles(ra), 'la': la, 'ra': ra * la,
+        'ra_la': np.where(np.isnan(ra), 0, la)})
+    keys = ['seg']
+    if by is not None:
+        segs[by] = user_data[by].to_numpy()
+        keys = [by, 'seg']
+    grouped = segs.groupby(keys, observed=True)
+    res = grouped['la'].sum().astype('int64').to_frame()
+    res['ra'] = grouped['ra'].sum(min_count=1) / grouped['ra_la'].sum()
+    res = res.reset_index()
+    if by is None:
+        total_la = res['la'].sum()
+    else:
+        total_la = res.groupby(by, observed=True)['la'].transform('sum')
+    res['la_perc'] = res['la'] / total_la
+    if costs is not None:
+        cost = costs if by is None else res[by].map(costs).astype('float64')
+        res['rac'] = round(cost * res['la_perc'] / (res['ra'] * total_la), 2)
+    return res
+
+def build_country_dim(countries):
+    # Country dimension from countries.csv (read with keep_default_na=False, so
+    # Namibia's 'na' stays a code): ISO numeric id, alpha2, ISO-3 (alpha3, upper
+    # case as plotly expects), display name and the name GA4 reports in geo.country.
+    # The csv lists the UN members and then the territories GA4 reports on their
+    # own (e.g. Hong Kong, Puerto Rico, and Kosovo under the user-assigned XKX).
+    countries = countries.copy()
+    countries['ga_name'] = countries['alpha3'].map(GA_COUNTRY_NAMES).fillna(countries['name'])
+    countries['alpha3'] = countries['alpha3'].str.upper()
+    countries['alpha2'] = countries['alpha2'].str.upper()
+    return countries
+
+def get_country_la(df, countries, weights=None):
+    """Returns LA per country_iso3 with the country's name, for ISO-3 choropleths.
+    Rows GA could not place in a country of the dimension are left out.
+    :param df: Learner or rollup cube rows with a country_iso3 column.
+    :param countries: Country dimension (ftm_data.get_countries).
+    :param weights: Optional column with the learner count of each row, e.g. 'la' for the cube.
+    """
+    grouped = df.groupby('country_iso3', observed=True)
+    la = grouped.size() if weights is None else grouped[weights].sum()
+    res = la.astype('int64').reset_index(name='LA')
+    res['country_iso3'] = res['country_iso3'].astype(str)
+    res['country'] = res['country_iso3'].map(countries.set_index('alpha3')['name'])
+    return res
+
+def get_rolling_la(daily_la, windows=LA_ROLLING_WINDOWS):
+    """Returns daily_la sorted by (campaign, LA_date) with a '<name> Rolling Mean'
+    column per window. Each mean is rolled within its own campaign, so a window
+    never spans two campaigns. daily_la is not modified.
+    :param daily_la: One row per campaign and LA_date with the day's LA.
+    :param windows: Column name prefix -> window length in rows (days with learners).
+    """
+    res = daily_la.sort_values(['campaign', 'LA_date']).reset_index(drop=True)
+    grouped = res.groupby('campaign', observed=True, sort=False)['LA']
+    for name, window in windows.items():
+        res[f'{name} Rolling Mean'] = grouped.rolling(window).mean().reset_index(level=0, drop=True)
+    return res
+
+def get_normalized_start_df(daily_la):
+    # Day 1 is each campaign's first LA_date; days without learners still
+    # count, so the x axis is calendar days since the campaign started.
+    res = daily_la.copy()
+    la_date = pd.to_datetime(res['LA_date'])
+    start_date = la_date.groupby(res['campaign']).transform('min')
+    res['day'] = (la_date - start_date).dt.days + 1
+    return res
+
+def get_month_ticks(days):
+    # One tick every 30 days up to the longest campaign.
+    tickvals = np.arange(0, days.max() + 1, 30)
+    ticktext = np.arange(0, len(tickvals), 1)
+    return tickvals, ticktext
+
+def get_lttb_indices(x, y, n_out):
+    # Largest-Triangle-Three-Buckets: keeps the first and last point and, from
+    # each of n_out - 2 equal buckets in between, the point forming the largest
+    # triangle with the previously kept point and the next bucket's mean.
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    edges = np.linspace(1, n - 1, n_out - 1).astype('int64')
+    res = np.empty(n_out, dtype='int64')
+    res[0] = 0
+    res[-1] = n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        next_hi = edges[i + 2] if i + 2 < len(edges) else n
+        avg_x = x[hi:next_hi].mean()
+        avg_y = y[hi:next_hi].mean()
+        area = np.abs((x[a] - avg_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (avg_y - y[a]))
+        a = lo + np.argmax(area)
+        res[i + 1] = a
+    return res
+
+def downsample_series(df, x, y, by=None, max_points=500):
+    """Returns the rows of df that keep the shape of every series within max_points
+    points (LTTB). Rows where y is missing (e.g. rolling mean warm-up) are dropped.
+    :param df: Rows sorted by x within each series.
+    :param x: Numeric or datetime x column.
+    :param y: Column to preserve the shape of.
+    :param by: Optional column identifying the series, e.g. 'campaign'.
+    """
+    df = df[df[y].notna()]
+    series = [df] if by is None else [s for _, s in df.groupby(by, observed=True, sort=False)]
+    keep = []
+    for s in series:
+        xs = s[x].to_numpy()
+        if np.issubdtype(xs.dtype, np.datetime64):
+            xs = xs.astype('datetime64[ns]').astype('int64')
+        keep.append(s.index[get_lttb_indices(xs.astype('float64'), s[y].to_numpy(dtype='float64'), max_points)])
+    return df.loc[np.concatenate(keep)] if keep else df
+
+def _get_day_numbers(dates):
+    return pd.to_datetime(dates).to_numpy().astype('datetime64[D]').astype('int64')
+
+def _get_codes(values, categories):
+    return pd.Categorical(values, categories=categories).codes.astype('int64')
+
+def build_campaign_index(users):
+    """Returns a campaign-membership index over users sorted by (app_id, country, LA_date).
+    :param users: ftm_users or its rollup cube, with categorical app_id and country.
+    """
+    days = _get_day_numbers(users['LA_date'])
+    min_day = days.min() if len(days) else 0
+    n_days = (days.max() - min_day + 1) if len(days) else 1
+    apps = users['app_id'].cat.categories
+    countries = users['country'].cat.categories
+    keys = ((users['app_id'].cat.codes.to_numpy().astype('int64') * len(countries)
+        + users['country'].cat.codes.to_numpy().astype('int64')) * n_days
+        + (days - min_day))
+    order = np.argsort(keys, kind='stable')
+    return {
+        'apps': apps,
+        'countries': countries,
+        'min_day': min_day,
+        'n_days': n_days,
+        'keys': keys[order],
+        'order': order,
+    }
+
+def select_campaign_users(users, index, campaigns):
+    """Returns the rows (learners or cube rows) of every campaign in one pass, with a
+    campaign column. Overlapping campaigns each get their own copy of the shared rows.
+    :param users: The frame build_campaign_index was built from.
+    :param index: Output of build_campaign_index(users).
+    :param campaigns: Campaign sheet rows (Campaign Name, Country, Start Date, End Date) plus app_id.
+    """
+    n_countries = len(index['countries'])
+    names = campaigns['Campaign Name'].to_numpy()
+    app_codes = _get_codes(campaigns['app_id'], index['apps'])
+    country_codes = _get_codes(campaigns['Country'], index['countries'])
+    first_day = np.clip(_get_day_numbers(campaigns['Start Date']) - index['min_day'], 0, index['n_days'])
+    last_day = np.clip(_get_day_numbers(campaigns['End Date']) - index['min_day'], -1, index['n_days'] - 1)
+    # A Country of 'All' is resolved as one date range per country.
+    all_countries = (campaigns['Country'] == 'All').to_numpy()
+    repeats = np.where(all_countries, n_countries, 1)
+    rows = np.repeat(np.arange(len(campaigns)), repeats)
+    country_codes = np.repeat(country_codes, repeats)
+    country_codes[np.repeat(all_countries, repeats)] = np.tile(np.arange(n_countries), all_countries.sum())
+    app_codes = app_codes[rows]
+    base = (app_codes * n_countries + country_codes) * index['n_days']
+    lo = np.searchsorted(index['keys'], base + first_day[rows], side='left')
+    hi = np.searchsorted(index['keys'], base + last_day[rows], side='right')
+    valid = (app_codes >= 0) & (country_codes >= 0) & (first_day[rows] <= last_day[rows])
+    lengths = np.where(valid, hi - lo, 0)
+    # Expand every [lo, hi) range into positions of the sorted index at once.
+    starts = np.repeat(lo - np.cumsum(lengths) + lengths, lengths)
+    positions = starts + np.arange(lengths.sum())
+    res = users.iloc[index['order'][positions]].reset_index(drop=True)
+    res['campaign'] = np.repeat(names[rows], lengths)
+    return res
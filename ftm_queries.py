@@ -0,0 +1,39 @@
+# ftm_queries.py
+# Aggregations over the ftm_users_cube rollup pushed down to BigQuery. A page
+# asks for a few measures grouped by a few cube columns and gets back only the
+# aggregated rows, rather than filtering the whole cube or learner rows in pandas.
+# The SQL is generated here and run by ftm_data.get_cube_aggregate.
+
+# name -> aggregate over the cube's rows. la is the learner count of a row, so
+# max_lvl_sum / la is the mean max level of a group.
+CUBE_MEASURES = {
+    'la': 'SUM(la)',
+    'max_lvl_sum': 'SUM(max_lvl * la)',
+}
+CUBE_DIMENSIONS = ['app_id', 'country', 'LA_date', 'max_lvl']
+
+def get_aggregate_sql(table, measures, by=(), countries=True):
+    """Returns the SQL aggregating a cube table over the @start..@end LA_date
+    range of the @apps, with one column per dimension in by and per measure.
+    :param table: Fully qualified table id, e.g. ftm_data.FTM_USERS_CUBE_TABLE.
+    :param measures: Names from CUBE_MEASURES.
+    :param by: Columns from CUBE_DIMENSIONS to group by, empty for one row of totals.
+    :param countries: Also filter on the @countries GA country names.
+    """
+    unknown = [name for name in measures if name not in CUBE_MEASURES]
+    unknown += [name for name in by if name not in CUBE_DIMENSIONS]
+    if unknown:
+        raise ValueError(f'Unknown cube measures or dimensions: {unknown}')
+    columns = list(by) + [f'{CUBE_MEASURES[name]} AS {name}' for name in measures]
+    country_filter = 'AND country IN UNNEST(@countries)' if countries else ''
+    group_by = f"GROUP BY {', '.join(by)}" if by else ''
+    order_by = f"ORDER BY {', '.join(by)}" if by else ''
+    return f"""
+        SELECT {', '.join(columns)}
+        FROM `{table}`
+        WHERE LA_date BETWEEN @start AND @end
+        AND app_id IN UNNEST(@apps)
+        {country_filter}
+        {group_by}
+        {order_by}
+    """
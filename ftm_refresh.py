@@ -0,0 +1,300 @@
+# ftm_refresh.py
+# Nightly refresh of ftm_users, generated from the FTM apps sheet. A full
+# refresh rebuilds the table with one scan of every app's events_20* shards; the
+# incremental refresh reads only the daily shards that arrived since the last
+# run and merges them in. The same scan keeps ftm_daily_activity (levels played
+# per cohort and day) and the ftm_users_cube rollup up to date.
+#
+# All statements except the raw event scan are plain SQL (CREATE TABLE AS,
+# INSERT ... WHERE NOT EXISTS, UPDATE ... FROM, CASE) so the merge can be run
+# against a local engine such as sqlite3, passing a get_events_sql that
+# SELECTs the same columns from synthetic shards (see tests/test_refresh.py).
+import datetime
+import argparse
+import functools
+import google.auth
+from google.cloud import bigquery
+from gsheetsdb import connect
+
+DATASET = 'dataexploration-193817.user_data'
+TABLES = {
+    'users': f'{DATASET}.ftm_users',
+    'state': f'{DATASET}.ftm_users_refresh_state',
+    'events': f'{DATASET}.ftm_users_delta_events',
+    'cohort': f'{DATASET}.ftm_users_delta_cohort',
+    'levels': f'{DATASET}.ftm_users_delta_levels',
+    'merged': f'{DATASET}.ftm_users_delta_merged',
+    'cube': f'{DATASET}.ftm_users_cube',
+    'affected': f'{DATASET}.ftm_users_delta_affected',
+    'activity': f'{DATASET}.ftm_daily_activity',
+}
+# Shards before this are not read. Apps can start later (see APP_START_SUFFIXES).
+START_SUFFIX = '210101'
+APP_START_SUFFIXES = {
+    'ftm-english': '221201',
+}
+
+def get_apps_from_sheet(sheet_url, credentials=None):
+    # (bq_project_id, bq_property_id) of every app listed in the FTM apps sheet,
+    # so new languages are picked up without touching the refresh SQL. The sheet
+    # is private, so credentials must be able to read it (see get_sheets_credentials).
+    conn = connect(credentials=credentials)
+    rows = conn.execute(f'SELECT bq_project_id, bq_property_id FROM "{sheet_url}"', headers=1).fetchall()
+    return [(project, str(int(float(property_id)))) for project, property_id in rows if project and property_id]
+
+def get_sheets_credentials():
+    # Application default credentials (e.g. GOOGLE_APPLICATION_CREDENTIALS set to
+    # the dashboard's service account key), scoped for Sheets.
+    credentials, _ = google.auth.default(scopes=['https://www.googleapis.com/auth/spreadsheets'])
+    return credentials
+
+def get_level_events_sql(apps, start, end):
+    # One row per LevelSuccess or LevelFail event in shards start..end (yymmdd
+    # suffixes). The level number and the event_date (a YYYYMMDD string in GA4)
+    # are parsed here once, so every table below holds real DATEs; succeeded is
+    # 1 for LevelSuccess and 0 for LevelFail.
+    selects = [f"""
+        SELECT user_pseudo_id, PARSE_DATE('%Y%m%d', event_date) AS event_date, app_info.id AS app_id, geo.country AS country,
+          SAFE_CAST(SUBSTR(params.value.string_value, (STRPOS(params.value.string_value, '_') + 1)) AS INT64) AS lvl,
+          IF(params.value.string_value LIKE 'LevelSuccess%', 1, 0) AS succeeded
+        FROM `{project}.analytics_{property_id}.events_20*`,
+        UNNEST(event_params) AS params
+        WHERE _table_suffix BETWEEN '{max(start, APP_START_SUFFIXES.get(project, start))}' AND '{end}'
+        AND event_name LIKE 'GamePlay'
+        AND params.key = 'action'
+        AND (params.value.string_value LIKE 'LevelSuccess%'
+        OR params.value.string_value LIKE 'LevelFail%')
+    """ for project, property_id in apps]
+    return '\n        UNION ALL\n'.join(selects)
+
+def get_full_refresh_sql(events_table):
+    # Single pass over the staged level events: LA_date, max level and level
+    # count are aggregated per (user, app, country) in one GROUP BY, then combined
+    # per user with window functions over the (much smaller) grouped rows. A max
+    # level reached more than once keeps its earliest date, as the merge does.
+    return f"""
+        SELECT user_pseudo_id, LA_date, app_id, country, max_lvl, max_lvl_date, total_lvls_succeeded
+        FROM (
+            SELECT user_pseudo_id, LA_date, app_id, country,
+              MAX(grp_max_lvl) OVER user_rows AS max_lvl,
+              FIRST_VALUE(grp_max_lvl_date) OVER (PARTITION BY user_pseudo_id
+                ORDER BY grp_max_lvl DESC, grp_max_lvl_date ASC) AS max_lvl_date,
+              SUM(grp_lvls_succeeded) OVER user_rows AS total_lvls_succeeded
+            FROM (
+                SELECT user_pseudo_id, app_id, country,
+                  MIN(IF(succeeded = 1 AND lvl = 1, event_date, NULL)) AS LA_date,
+                  MAX(IF(succeeded = 1, lvl, NULL)) AS grp_max_lvl,
+                  ARRAY_AGG(IF(succeeded = 1, event_date, NULL) IGNORE NULLS
+                    ORDER BY IF(succeeded = 1, lvl, NULL) DESC, event_date ASC LIMIT 1)[SAFE_OFFSET(0)] AS grp_max_lvl_date,
+                  COUNTIF(succeeded = 1 AND lvl IS NOT NULL) AS grp_lvls_succeeded
+                FROM {events_table}
+                GROUP BY user_pseudo_id, app_id, country
+            )
+            WINDOW user_rows AS (PARTITION BY user_pseudo_id)
+        )
+        WHERE LA_date IS NOT NULL
+        ORDER BY LA_date
+    """
+
+def get_cube_sql(users_table, where=''):
+    # Rollup of ftm_users at (app_id, country, LA_date, max_lvl) grain. la is the
+    # learner count, so LA = SUM(la), the max_lvl sum is SUM(max_lvl * la) and
+    # the rows of one key form its per-level histogram.
+    return f"""
+        SELECT u.app_id, u.country, u.LA_date, u.max_lvl, COUNT(*) AS la
+        FROM {users_table} AS u
+        {where}
+        GROUP BY u.app_id, u.country, u.LA_date, u.max_lvl
+    """
+
+def get_daily_activity_sql(events_table, users_table):
+    # Levels played (LevelSuccess and LevelFail) per (app_id, country, LA_date)
+    # cohort and event_date. Events are attributed to the learner row of the
+    # same app and country, so a learner is never counted twice. Only events from
+    # LA_date on count: an incremental run has no learner row for a user's
+    # earlier shards, so a full rebuild must not count them either.
+    return f"""
+        SELECT u.app_id, u.country, u.LA_date, e.event_date, COUNT(*) AS levels_played
+        FROM {events_table} AS e
+        JOIN {users_table} AS u ON e.user_pseudo_id = u.user_pseudo_id
+          AND e.app_id = u.app_id
+          AND e.country = u.country
+        WHERE e.event_date >= u.LA_date
+        GROUP BY u.app_id, u.country, u.LA_date, e.event_date
+    """
+
+def get_full_refresh_statements(apps, end, tables=TABLES, start=START_SUFFIX):
+    t = {k: f'`{v}`' for k, v in tables.items()}
+    # The loaders filter on an LA_date range plus app and country, so these
+    # predicates prune to the campaign's partitions and clustered blocks.
+    layout = 'PARTITION BY LA_date CLUSTER BY app_id, country'
+    return [
+        # Read every shard once into a staging table shared by the steps below.
+        f"DROP TABLE IF EXISTS {t['events']}",
+        f"CREATE TABLE {t['events']} AS {get_level_events_sql(apps, start, end)}",
+        f"CREATE OR REPLACE TABLE {t['users']} {layout} AS {get_full_refresh_sql(t['events'])}",
+        f"CREATE OR REPLACE TABLE {t['cube']} {layout} AS {get_cube_sql(t['users'])}",
+        f"CREATE OR REPLACE TABLE {t['activity']} {layout} AS {get_daily_activity_sql(t['events'], t['users'])}",
+        # A fresh dataset has no state table yet.
+        f"CREATE TABLE IF NOT EXISTS {t['state']} (last_suffix STRING)",
+        f"DELETE FROM {t['state']} WHERE TRUE",
+        f"INSERT INTO {t['state']} (last_suffix) VALUES ('{end}')",
+        # The staged events hold the whole history and are not needed once the tables are built.
+        f"DROP TABLE {t['events']}",
+    ]
+
+def get_refresh_statements(level_events_sql, end, tables=TABLES):
+    t = {k: f'`{v}`' for k, v in tables.items()}
+    affected_sql = f"""
+        SELECT 1 FROM {t['affected']} AS a
+        WHERE a.app_id = {{alias}}.app_id
+        AND a.country = {{alias}}.country
+        AND a.LA_date = {{alias}}.LA_date
+    """
+    return [
+        # Read the new shards once into a small staging table.
+        f"DROP TABLE IF EXISTS {t['events']}",
+        f"CREATE TABLE {t['events']} AS {level_events_sql}",
+        f"DROP TABLE IF EXISTS {t['cohort']}",
+        f"""CREATE TABLE {t['cohort']} AS
+            SELECT user_pseudo_id, app_id, country, MIN(event_date) AS LA_date
+            FROM {t['events']}
+            WHERE succeeded = 1 AND lvl = 1
+            GROUP BY user_pseudo_id, app_id, country""",
+        f"DROP TABLE IF EXISTS {t['levels']}",
+        f"""CREATE TABLE {t['levels']} AS
+            SELECT e.user_pseudo_id, m.max_lvl, MIN(e.event_date) AS max_lvl_date, m.lvls_succeeded
+            FROM {t['events']} AS e
+            JOIN (
+                SELECT user_pseudo_id, MAX(lvl) AS max_lvl, COUNT(lvl) AS lvls_succeeded
+                FROM {t['events']}
+                WHERE succeeded = 1
+                GROUP BY user_pseudo_id
+            ) AS m ON e.user_pseudo_id = m.user_pseudo_id AND e.lvl = m.max_lvl
+            WHERE e.succeeded = 1
+            GROUP BY e.user_pseudo_id, m.max_lvl, m.lvls_succeeded""",
+        # New learners start with empty level data, filled in by the update below.
+        f"""INSERT INTO {t['users']} (user_pseudo_id, LA_date, app_id, country, max_lvl, max_lvl_date, total_lvls_succeeded)
+            SELECT c.user_pseudo_id, c.LA_date, c.app_id, c.country, 0, NULL, 0
+            FROM {t['cohort']} AS c
+            WHERE NOT EXISTS (
+                SELECT 1 FROM {t['users']} AS u
+                WHERE u.user_pseudo_id = c.user_pseudo_id
+                AND u.app_id = c.app_id
+                AND u.country = c.country
+            )""",
+        f"DROP TABLE IF EXISTS {t['merged']}",
+        f"""CREATE TABLE {t['merged']} AS
+            SELECT d.user_pseudo_id,
+              CASE WHEN d.max_lvl > u.max_lvl THEN d.max_lvl ELSE u.max_lvl END AS max_lvl,
+              CASE WHEN d.max_lvl > u.max_lvl THEN d.max_lvl_date ELSE u.max_lvl_date END AS max_lvl_date,
+              u.total_lvls_succeeded + d.lvls_succeeded AS total_lvls_succeeded
+            FROM {t['levels']} AS d
+            JOIN (
+                SELECT user_pseudo_id, MAX(max_lvl) AS max_lvl, MAX(max_lvl_date) AS max_lvl_date,
+                  MAX(total_lvls_succeeded) AS total_lvls_succeeded
+                FROM {t['users']}
+                GROUP BY user_pseudo_id
+            ) AS u ON d.user_pseudo_id = u.user_pseudo_id""",
+        f"""UPDATE {t['users']} AS u
+            SET max_lvl = m.max_lvl,
+              max_lvl_date = m.max_lvl_date,
+              total_lvls_succeeded = m.total_lvls_succeeded
+            FROM {t['merged']} AS m
+            WHERE u.user_pseudo_id = m.user_pseudo_id""",
+        # Re-roll only the cube keys whose learners were inserted or updated.
+        f"DROP TABLE IF EXISTS {t['affected']}",
+        f"""CREATE TABLE {t['affected']} AS
+            SELECT DISTINCT u.app_id, u.country, u.LA_date
+            FROM {t['users']} AS u
+            JOIN {t['merged']} AS m ON u.user_pseudo_id = m.user_pseudo_id""",
+        f"""DELETE FROM {t['cube']} AS c
+            WHERE EXISTS ({affected_sql.format(alias='c')})""",
+        f"""INSERT INTO {t['cube']} (app_id, country, LA_date, max_lvl, la)
+            {get_cube_sql(t['users'], f"WHERE EXISTS ({affected_sql.format(alias='u')})")}""",
+        # The new shards only hold new event dates, so their activity is appended.
+        f"""INSERT INTO {t['activity']} (app_id, country, LA_date, event_date, levels_played)
+            {get_daily_activity_sql(t['events'], t['users'])}""",
+        f"DELETE FROM {t['state']} WHERE TRUE",
+        f"INSERT INTO {t['state']} (last_suffix) VALUES ('{end}')",
+    ]
+
+def get_last_suffix(run, tables=TABLES):
+    rows = run(f"SELECT MAX(last_suffix) AS last_suffix FROM `{tables['state']}`")
+    return rows[0][0] if rows else None
+
+def get_latest_suffix_sql(apps):
+    # Suffix of the latest daily shard every app has exported. GA4 writes a day's
+    # shard late on the next day, so a run must stop at the last day all apps
+    # have rather than assume yesterday is there.
+    selects = [f"""
+        SELECT MAX(SUBSTR(table_name, 10)) AS latest
+        FROM `{project}.analytics_{property_id}.INFORMATION_SCHEMA.TABLES`
+        WHERE table_name LIKE 'events_20%'
+    """ for project, property_id in apps]
+    return f"SELECT MIN(latest) FROM ({' UNION ALL '.join(selects)})"
+
+def get_end_suffix(run, latest_suffix_sql, today):
+    # Shards are named events_20yymmdd; today's shard is still being written.
+    # Returns None if no shard has been exported at all.
+    rows = run(latest_suffix_sql)
+    latest = rows[0][0] if rows else None
+    if latest is None:
+        return None
+    return min(latest, (today - datetime.timedelta(days=1)).strftime('%y%m%d'))
+
+def get_shard_range(last_suffix, end):
+    start = datetime.datetime.strptime(last_suffix, '%y%m%d').date() + datetime.timedelta(days=1)
+    if end is None or start.strftime('%y%m%d') > end:
+        return None
+    return start.strftime('%y%m%d'), end
+
+def refresh_full(run, apps, today, tables=TABLES):
+    # Rebuilds ftm_users from every exported shard and resets the state.
+    end = get_end_suffix(run, get_latest_suffix_sql(apps), today)
+    if end is None:
+        raise ValueError('None of the apps has exported a daily events shard yet')
+    for sql_query in get_full_refresh_statements(apps, end, tables):
+        run(sql_query)
+    return START_SUFFIX, end
+
+def refresh_incremental(run, get_events_sql, latest_suffix_sql, today, tables=TABLES):
+    """Merges the shards that arrived since the last run into ftm_users.
+    Returns the (start, end) shard suffixes processed, or None if up to date.
+    :param run: Callable (sql_query) -> list of row tuples.
+    :param get_events_sql: Callable (start, end) -> SELECT of LevelSuccess and LevelFail
+        events (user_pseudo_id, event_date, app_id, country, lvl, succeeded) in those shards,
+        e.g. functools.partial(get_level_events_sql, apps).
+    :param latest_suffix_sql: SELECT of the latest shard suffix every app has exported,
+        e.g. get_latest_suffix_sql(apps). A shard that lands late is read by the next run.
+    :param today: Date of the run; shards up to yesterday are processed.
+    """
+    last_suffix = get_last_suffix(run, tables)
+    if last_suffix is None:
+        raise ValueError(f"{tables['state']} is empty, seed it with the last shard of a full refresh")
+    shard_range = get_shard_range(last_suffix, get_end_suffix(run, latest_suffix_sql, today))
+    if shard_range is None:
+        return None
+    start, end = shard_range
+    for sql_query in get_refresh_statements(get_events_sql(start, end), end, tables):
+        run(sql_query)
+    return shard_range
+
+def get_bq_runner(client):
+    def run(sql_query):
+        return [tuple(row.values()) for row in client.query(sql_query).result()]
+    return run
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Incremental nightly refresh of ftm_users.')
+    parser.add_argument('--apps-sheet', required=True, help='URL of the FTM apps Google Sheet.')
+    parser.add_argument('--full', action='store_true', help='Rebuild ftm_users from every shard.')
+    parser.add_argument('--today', type=datetime.date.fromisoformat, default=datetime.date.today())
+    args = parser.parse_args()
+    apps = get_apps_from_sheet(args.apps_sheet, get_sheets_credentials())
+    run = get_bq_runner(bigquery.Client())
+    if args.full:
+        print(refresh_full(run, apps, args.today))
+    else:
+        print(refresh_incremental(run, functools.partial(get_level_events_sql, apps),
+            get_latest_suffix_sql(apps), args.today))
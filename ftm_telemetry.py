@@ -0,0 +1,159 @@
+# ftm_telemetry.py
+# I/O telemetry for the loaders in ftm_data. Every call of a traced loader is one
+# record: memo and disk cache hit or miss, wall time per phase of its BigQuery or
+# Sheets calls, rows and bytes returned and, for BigQuery, the bytes processed
+# and whether the job was answered from BigQuery's own cache. Records are logged
+# as JSON lines on the 'ftm.telemetry' logger, and the most recent ones are kept
+# in memory for the diagnostics view (ftm_diagnostics).
+import os
+import json
+import time
+import hashlib
+import logging
+import datetime
+import functools
+import threading
+import collections
+from contextlib import contextmanager
+import pandas as pd
+from streamlit import source_util
+from streamlit.runtime import Runtime
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+TELEMETRY_MAX_RECORDS = int(os.environ.get('FTM_TELEMETRY_MAX_RECORDS', 5000))
+MAIN_SCRIPT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Summary.py')
+# submit: job creation, wait: until the results are ready, fetch: download,
+# convert: Arrow to pandas. Time not spent in a phase (loader-side typing,
+# cache reads) is reported as other_s.
+PHASES = ['submit', 'wait', 'fetch', 'convert']
+# Fields summed over the queries of one loader call; the others keep the last value.
+COUNTERS = ['queries', 'rows', 'bytes', 'estimated_bytes', 'bytes_processed']
+# Loader kinds whose arguments are secrets (the sheet URLs in st.secrets). Their
+# arguments are recorded as a digest, so calls can still be told apart, and
+# their errors by type only, as the messages can quote the URL or sheet id.
+SECRET_ARG_KINDS = ['sheets', 'drive']
+
+logger = logging.getLogger('ftm.telemetry')
+if not logger.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(_handler)
+    logger.setLevel(os.environ.get('FTM_TELEMETRY_LOG_LEVEL', 'INFO'))
+    logger.propagate = False
+
+_records = collections.deque(maxlen=TELEMETRY_MAX_RECORDS)
+_local = threading.local()
+
+def get_page_name(ctx):
+    # Pages are only known under `streamlit run`, whose script runner has
+    # already listed them by the time a loader runs.
+    if ctx is None or not Runtime.exists():
+        return None
+    page = source_util.get_pages(MAIN_SCRIPT_PATH).get(ctx.page_script_hash)
+    return page['page_name'] if page else ctx.page_script_hash
+
+def _get_stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+def _get_call():
+    stack = _get_stack()
+    return stack[-1] if stack else None
+
+def record_io(**values):
+    """Adds values to the record of the traced loader call running in this thread.
+    Anything reported means the loader's body ran, so the call was a memo miss.
+    Does nothing outside a traced call.
+    """
+    call = _get_call()
+    if call is None:
+        return
+    call['memo'] = 'miss'
+    for key, value in values.items():
+        if key in COUNTERS:
+            call[key] = (call.get(key) or 0) + (value or 0)
+        else:
+            call[key] = value
+
+@contextmanager
+def phase(name):
+    # Times one phase (see PHASES) of the current traced call's I/O.
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        call = _get_call()
+        if call is not None:
+            call['memo'] = 'miss'
+            call[f'{name}_s'] += time.perf_counter() - start
+
+def _format_args(kind, args):
+    text = repr(args)
+    if kind in SECRET_ARG_KINDS:
+        return 'sha1:' + hashlib.sha1(text.encode()).hexdigest()[:12]
+    return text[:200]
+
+def _new_record(func, kind, args, kwargs):
+    ctx = get_script_run_ctx()
+    record = {
+        'ts': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='milliseconds'),
+        'session_id': ctx.session_id if ctx is not None else None,
+        'page': get_page_name(ctx),
+        'loader': func.__name__,
+        'kind': kind,
+        'args': _format_args(kind, args + tuple(kwargs.values())),
+        'memo': 'hit',
+        'disk': None,
+        'duration_s': None,
+    }
+    record.update({f'{name}_s': 0.0 for name in PHASES})
+    record.update({
+        'other_s': None,
+        'queries': 0,
+        'rows': None,
+        'bytes': None,
+        'estimated_bytes': None,
+        'bytes_processed': None,
+        'cache_hit': None,
+        'job_id': None,
+        'result_rows': None,
+        'result_bytes': None,
+        'stale': None,
+        'error': None,
+    })
+    return record
+
+def traced(kind):
+    """Records every call of a loader. Put it above @st.experimental_memo so memo
+    hits are recorded too.
+    :param kind: Source the loader reads, e.g. 'bigquery' or 'sheets'.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            record = _new_record(func, kind, args, kwargs)
+            stack = _get_stack()
+            stack.append(record)
+            start = time.perf_counter()
+            try:
+                result = func(*args, **kwargs)
+                if isinstance(result, pd.DataFrame):
+                    record['result_rows'] = len(result)
+                    record['result_bytes'] = int(result.memory_usage(index=False).sum())
+                return result
+            except Exception as e:
+                record['error'] = type(e).__name__ if kind in SECRET_ARG_KINDS else repr(e)
+                raise
+            finally:
+                stack.pop()
+                record['duration_s'] = time.perf_counter() - start
+                record['other_s'] = record['duration_s'] - sum(record[f'{name}_s'] for name in PHASES)
+                _records.append(record)
+                logger.info(json.dumps(record, default=str))
+        return wrapper
+    return decorator
+
+def get_records():
+    # The recorded loader calls of this server process, oldest first.
+    return pd.DataFrame(list(_records))
@@ -3,73 +3,15 @@
 # Last updated Dec 2022
 # 01_Campaign_Comparison_Summary.py
 import streamlit as st
-from google.oauth2 import service_account
-from google.cloud import bigquery
-from gsheetsdb import connect
 import datetime
 import pandas as pd
-import db_dtypes
 import json
 import plotly
 import plotly.express as px
 import plotly.graph_objects as go
+from ftm_data import get_sheets
 
 # --- DATA ---
-# Create a Google Sheets connection object.
-credentials = service_account.Credentials.from_service_account_info(
-    st.secrets["gcp_service_account"],
-    scopes=[
-        "https://www.googleapis.com/auth/spreadsheets",
-    ]
-)
-conn = connect(credentials=credentials)
-# Create BigQuery API client.
-bq_credentials = service_account.Credentials.from_service_account_info(
-    st.secrets["gcp_service_account"]
-)
-client = bigquery.Client(credentials=bq_credentials)
-
-def run_query(query):
-    rows = conn.execute(query, headers=1)
-    rows = rows.fetchall()
-    return rows
-
-@st.experimental_memo
-def get_campaign_data():
-    campaign_sheet_url = st.secrets["Campaign_gsheets_url"]
-    campaign_rows = run_query(f'SELECT * FROM "{campaign_sheet_url}"')
-    campaign_data = pd.DataFrame(columns = ['Campaign Name', 'Language', 'Country', 'Start Date', 'End Date', 'Total Cost (USD)'],
-                            data = campaign_rows)
-    campaign_data['Start Date'] = (pd.to_datetime(campaign_data['Start Date'])).dt.date
-    campaign_data['End Date'] = (pd.to_datetime(campaign_data['End Date'])
-                                    + pd.DateOffset(months=1) - pd.Timedelta(1, unit='D')).dt.date
-    campaign_data = campaign_data.astype({
-        'Total Cost (USD)': 'float'
-    })
-    return campaign_data
-
-@st.experimental_memo
-def get_apps_data():
-    apps_sheet_url = st.secrets["ftm_apps_gsheets_url"]
-    apps_rows = run_query(f'SELECT app_id, language, bq_property_id, bq_project_id, total_lvls FROM "{apps_sheet_url}"')
-    apps_data = pd.DataFrame(columns = ['app_id', 'language', 'bq_property_id', 'bq_project_id', 'total_lvls'],
-        data = apps_rows)
-    return apps_data
-
-@st.experimental_memo
-def get_campaign_metrics():
-    camp_metrics_url = st.secrets["campaign_metrics_gsheets_url"]
-    camp_metrics_rows = run_query(f'SELECT * FROM "{camp_metrics_url}"')
-    camp_metrics_data = pd.DataFrame(columns = ['campaign_name', 'la', 'lac', 'ra', 'rac'],
-                            data = camp_metrics_rows)
-    camp_metrics_data = camp_metrics_data.astype({
-        'la': 'int',
-        'lac': 'float',
-        'ra': 'float',
-        'rac': 'float'
-    })
-    return camp_metrics_data
-
 # def get_color_map(camps):
 #     res = {}
 #     palette = [
@@ -108,7 +50,7 @@ def_df = pd.DataFrame(
 )
 expander.table(def_df)
 
-ftm_campaigns = get_campaign_data()
+ftm_campaigns, ftm_campaign_metrics = get_sheets('campaigns', 'campaign_metrics')
 select_campaigns = st.sidebar.multiselect(
     "Select Campaign(s)",
     ftm_campaigns['Campaign Name'],
@@ -119,7 +61,6 @@ select_campaigns = st.sidebar.multiselect(
 # GANTT CHART
 ftm_campaigns = ftm_campaigns[ftm_campaigns['Campaign Name'].isin(st.session_state['campaigns'])]
 ftm_campaigns['Total Cost (USD)'] = round(ftm_campaigns['Total Cost (USD)'],2)
-ftm_campaign_metrics = get_campaign_metrics()
 ftm_campaign_metrics = ftm_campaign_metrics[ftm_campaign_metrics['campaign_name'].isin(st.session_state['campaigns'])]
 gantt_df = pd.merge(ftm_campaigns, ftm_campaign_metrics, how='left', left_on='Campaign Name', right_on='campaign_name')
 gantt = px.timeline(gantt_df,
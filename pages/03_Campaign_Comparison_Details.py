@@ -2,109 +2,20 @@
 # Last updated Dec 2022
 # 03_Campaign_Comparison_Details.py
 import streamlit as st
-from google.oauth2 import service_account
-from google.cloud import bigquery
-from gsheetsdb import connect
 import datetime
 import pandas as pd
-import db_dtypes
 import json
 import plotly
 import plotly.express as px
 import plotly.graph_objects as go
 from millify import millify
 import numpy as np
+from ftm_data import (FTM_USERS_CUBE_TABLE, get_sheets, get_table_version, get_user_cube, get_campaign_index, get_la_series,
+    show_stale_badge, QueryBudgetExceeded)
+from ftm_metrics import get_ra_segments, get_normalized_start_df, select_campaign_users
+from ftm_charts import LA_MAX_POINTS, get_daily_la_fig, get_weekly_la_fig, get_monthly_la_fig
 
 # --- DATA ---
-# Create a Google Sheets connection object.
-credentials = service_account.Credentials.from_service_account_info(
-    st.secrets["gcp_service_account"],
-    scopes=[
-        "https://www.googleapis.com/auth/spreadsheets",
-    ]
-)
-conn = connect(credentials=credentials)
-# Create BigQuery API client.
-bq_credentials = service_account.Credentials.from_service_account_info(
-    st.secrets["gcp_service_account"]
-)
-client = bigquery.Client(credentials=bq_credentials)
-
-def run_query(query):
-    rows = conn.execute(query, headers=1)
-    rows = rows.fetchall()
-    return rows
-
-@st.experimental_memo
-def get_campaign_data():
-    campaign_sheet_url = st.secrets["Campaign_gsheets_url"]
-    campaign_rows = run_query(f'SELECT * FROM "{campaign_sheet_url}"')
-    campaign_data = pd.DataFrame(columns = ['Campaign Name', 'Language', 'Country', 'Start Date', 'End Date', 'Total Cost (USD)'],
-                            data = campaign_rows)
-    campaign_data['Start Date'] = (pd.to_datetime(campaign_data['Start Date'])).dt.date
-    campaign_data['End Date'] = (pd.to_datetime(campaign_data['End Date'])
-                                    + pd.DateOffset(months=1) - pd.Timedelta(1, unit='D')).dt.date
-    campaign_data = campaign_data.astype({
-        'Total Cost (USD)': 'float'
-    })
-    return campaign_data
-
-@st.experimental_memo
-def get_user_data(today):
-    sql_query = f"""
-        SELECT * FROM `dataexploration-193817.user_data.ftm_users`
-    """
-    rows_raw = client.query(sql_query)
-    rows = [dict(row) for row in rows_raw]
-    df = pd.DataFrame(rows)
-    df['LA_date'] = (pd.to_datetime(df['LA_date'])).dt.date
-    df['max_lvl_date'] = (pd.to_datetime(df['max_lvl_date'])).dt.date
-    return df
-
-@st.experimental_memo
-def get_apps_data():
-    apps_sheet_url = st.secrets["ftm_apps_gsheets_url"]
-    apps_rows = run_query(f'SELECT app_id, language, bq_property_id, bq_project_id, total_lvls FROM "{apps_sheet_url}"')
-    apps_data = pd.DataFrame(columns = ['app_id', 'language', 'bq_property_id', 'bq_project_id', 'total_lvls'],
-        data = apps_rows)
-    return apps_data
-
-@st.experimental_memo
-def get_ra_segments(campagin_cost, app_data, user_data):
-    df = pd.DataFrame(columns = ['segment', 'la', 'perc_la', 'ra', 'rac'])
-    total_lvls = app_data['total_lvls'][0]
-    seg = []
-    ra = []
-    for lvl in user_data['max_lvl']:
-        perc = lvl / total_lvls
-        ra.append(perc)
-        if perc < .1:
-            seg.append(.1)
-        elif .1 <= perc < .2:
-            seg.append(.2)
-        elif .2 <= perc < .3:
-            seg.append(.3)
-        elif .3 <= perc < .4:
-            seg.append(.4)
-        elif .4 <= perc < .5:
-            seg.append(.5)
-        elif .5 <= perc < .6:
-            seg.append(.6)
-        elif .6 <= perc < .7:
-            seg.append(.7)
-        elif .7 <= perc < .8:
-            seg.append(.8)
-        elif .8 <= perc < .9:
-            seg.append(.9)
-        else:
-            seg.append(1)
-    user_data['seg'] = seg
-    user_data['ra'] = ra
-    res = user_data.groupby('seg').agg(la=('user_pseudo_id','count'), ra=('ra','mean')).reset_index()
-    res['la_perc'] = round(res['la'] / res['la'].sum(),2)
-    res['rac'] = round(campaign_cost * res['la_perc'] / (res['ra'] * res['la'].sum()),2)
-    return res
-
 # def get_daily_la_fig(daily_la):
 #     daily_la_fig = px.line(daily_la,
 #         x='LA_date',
@@ -140,125 +51,6 @@ def get_ra_segments(campagin_cost, app_data, user_data):
 #         title='Monthly LA')
 #     return monthly_la_fig
 
-def get_daily_la_fig(daily_la, norm):
-    if norm == True:
-        daily_la_fig = px.line(daily_la,
-            x='LA_date',
-            y='LA',
-            color='campaign',
-            labels={'LA_date': 'Day',
-                'campaign': 'Campaign',
-                'Learners Acquired': 'LA'},
-            title="Daily LA")
-        daily_la_fig.update_xaxes(
-            tickmode='array',
-            tickvals = np.arange(0, len(daily_la['LA_date']), 30),
-            ticktext=np.arange(0, 13, 1)
-        )
-        daily_la_fig.update_layout(
-            xaxis_title='Date (Month)'
-        )
-    else:
-        daily_la_fig = px.line(daily_la,
-            x='LA_date',
-            y='LA',
-            color='campaign',
-            labels={'LA_date': 'Date',
-                'campaign': 'Campaign',
-                'Learners Acquired': 'LA'},
-            title='Daily LA')
-    return daily_la_fig
-
-def get_weekly_la_fig(daily_la, norm):
-    daily_la['Weekly Rolling Mean'] = daily_la['LA'].rolling(7).mean()
-    if norm == True:
-        weekly_la_fig = px.line(daily_la,
-            x='LA_date',
-            y='Weekly Rolling Mean',
-            color='campaign',
-            labels={'LA_date': 'Day',
-                'campaign': 'Campaign',
-                'Weekly Rolling Mean': 'LA'},
-            title='Weekly LA')
-        weekly_la_fig.update_xaxes(
-            tickmode='array',
-            tickvals = np.arange(0, len(daily_la['LA_date']), 30),
-            ticktext=np.arange(0, 13, 1)
-        )
-        weekly_la_fig.update_layout(
-            xaxis_title='Date (Month)'
-        )
-    else:
-        weekly_la_fig = px.line(daily_la,
-            x='LA_date',
-            y='Weekly Rolling Mean',
-            color='campaign',
-            labels={'LA_date': 'Date',
-                'campaign': 'Campaign',
-                'Weekly Rolling Mean': 'LA'},
-            title='Weekly LA')
-    return weekly_la_fig
-
-def get_monthly_la_fig(daily_la, norm):
-    daily_la['Monthly Rolling Mean'] = daily_la['LA'].rolling(30).mean()
-    if norm == True:
-        monthly_la_fig = px.line(daily_la,
-            x='LA_date',
-            y='Monthly Rolling Mean',
-            color='campaign',
-            labels={'LA_date': 'Day',
-                'campaign': 'Campaign',
-                'Monthly Rolling Mean': 'LA'},
-            title='Monthly LA')
-        monthly_la_fig.update_xaxes(
-            tickmode='array',
-            tickvals = np.arange(0, len(daily_la['LA_date']), 30),
-            ticktext=np.arange(0, 13, 1)
-        )
-        monthly_la_fig.update_layout(
-            xaxis_title='Date (Month)'
-        )
-    else:
-        monthly_la_fig = px.line(daily_la,
-            x='LA_date',
-            y='Monthly Rolling Mean',
-            color='campaign',
-            labels={'LA_date': 'Date',
-                'campaign': 'Campaign',
-                'Monthly Rolling Mean': 'LA'},
-            title='Monthly LA')
-    return monthly_la_fig
-
-@st.experimental_memo
-def get_normalized_start_df(daily_la):
-    res = daily_la
-    res['day'] = -1
-    camp = res['campaign'][0]
-    counter = 0
-    for index, row in res.iterrows():
-        if row['campaign'] == camp:
-            counter +=1
-            res['day'][index] = counter
-        else:
-            counter = 1
-            res['day'][index] = counter
-            camp = row['campaign']
-    return res
-
-@st.experimental_memo
-def get_campaign_metrics():
-    camp_metrics_url = st.secrets["campaign_metrics_gsheets_url"]
-    camp_metrics_rows = run_query(f'SELECT * FROM "{camp_metrics_url}"')
-    camp_metrics_data = pd.DataFrame(columns = ['campaign_name', 'la', 'lac', 'ra', 'rac'],
-                            data = camp_metrics_rows)
-    camp_metrics_data = camp_metrics_data.astype({
-        'la': 'int',
-        'lac': 'float',
-        'ra': 'float',
-        'rac': 'float'
-    })
-    return camp_metrics_data
-
 # --- UI ---
 st.title('Campaign Comparison Details')
 expander = st.expander('Definitions')
@@ -282,7 +74,7 @@ def_df = pd.DataFrame(
 )
 expander.table(def_df)
 
-ftm_campaigns = get_campaign_data()
+ftm_campaigns, ftm_apps, campaign_data = get_sheets('campaigns', 'apps', 'campaign_metrics')
 select_campaigns = st.sidebar.multiselect(
     "Select Campaign(s)",
     ftm_campaigns['Campaign Name'],
@@ -291,28 +83,24 @@ select_campaigns = st.sidebar.multiselect(
 )
 
 # DAILY LEARNERS ACQUIRED
-ftm_users = get_user_data(pd.to_datetime("today").date())
-ftm_apps = get_apps_data()
-users_df = pd.DataFrame()
-for campaign in st.session_state['campaigns']:
-    start_date = ftm_campaigns.loc[ftm_campaigns['Campaign Name'] == campaign, 'Start Date'].item()
-    end_date = ftm_campaigns.loc[ftm_campaigns['Campaign Name'] == campaign, 'End Date'].item()
-    language = ftm_campaigns.loc[ftm_campaigns['Campaign Name'] == campaign, 'Language'].item()
-    app = ftm_apps.loc[ftm_apps['language'] == language, 'app_id'].item()
-    country = ftm_campaigns.loc[ftm_campaigns['Campaign Name'] == campaign, 'Country'].item()
-    if country == 'All':
-        temp = ftm_users[(ftm_users['LA_date'] >= start_date) & (ftm_users['LA_date'] <= end_date) & (ftm_users['app_id'] == app)]
-    else:
-        temp = ftm_users[(ftm_users['LA_date'] >= start_date) & (ftm_users['LA_date'] <= end_date) & (ftm_users['app_id'] == app) & (ftm_users['country'] == country)]
-    temp['campaign'] = campaign
-    users_df = pd.concat([users_df, temp])
-
-daily_la = users_df.groupby(['campaign', 'LA_date'])['user_pseudo_id'].count().reset_index(name='LA')
+cube_version = get_table_version(FTM_USERS_CUBE_TABLE)
+try:
+    with st.spinner('Loading learner data...'):
+        ftm_cube = get_user_cube(cube_version)
+        campaign_index = get_campaign_index(cube_version)
+except QueryBudgetExceeded as e:
+    st.error(f'Learner data could not be loaded: {e}.')
+    st.stop()
+show_stale_badge(ftm_cube)
+selected_campaigns = ftm_campaigns[ftm_campaigns['Campaign Name'].isin(st.session_state['campaigns'])]
+selected_campaigns = pd.merge(selected_campaigns, ftm_apps[['language', 'app_id']], how='left', left_on='Language', right_on='language')
+cube_df = select_campaign_users(ftm_cube, campaign_index, selected_campaigns)
+
+daily_la = get_la_series(cube_df.groupby(['campaign', 'LA_date'])['la'].sum().reset_index(name='LA'))
 
-campaign_data = get_campaign_metrics()
 campaign_data = campaign_data[campaign_data['campaign_name'].isin(st.session_state['campaigns'])]
 col1, col2 = st.columns(2)
-col1.metric('Total LA', millify(str(len(users_df))))
+col1.metric('Total LA', millify(str(cube_df['la'].sum())))
 avg_ra = np.average(campaign_data['ra'], weights=campaign_data['la'])
 col2.metric('Avg RA (Weighted)', millify(avg_ra, precision=2))
 st.markdown('***')
@@ -325,22 +113,19 @@ if radio1 == 'Normalized Start':
     daily_la = get_normalized_start_df(daily_la)
     daily_la = daily_la.rename(columns={'LA_date':'orig_date', 'day': 'LA_date'})
 if radio == 'Daily LA':
-    la_fig = get_daily_la_fig(daily_la, norm)
+    la_fig = get_daily_la_fig(daily_la, norm, LA_MAX_POINTS)
 elif radio == 'Weekly LA Rolling Mean':
-    la_fig = get_weekly_la_fig(daily_la, norm)
+    la_fig = get_weekly_la_fig(daily_la, norm, LA_MAX_POINTS)
 elif radio == 'Monthly LA Rolling Mean':
-    la_fig = get_monthly_la_fig(daily_la, norm)
+    la_fig = get_monthly_la_fig(daily_la, norm, LA_MAX_POINTS)
 st.plotly_chart(la_fig)
 st.markdown('***')
 
 # LA BY RA DECILE
-ra_segs = pd.DataFrame()
-for campaign in st.session_state['campaigns']:
-    campaign_cost = ftm_campaigns.loc[ftm_campaigns['Campaign Name'] == campaign, 'Total Cost (USD)'].item()
-    temp = get_ra_segments(campaign_cost, ftm_apps, users_df[users_df['campaign'] == campaign])
-    temp['campaign'] = campaign
-    temp['campaign_cost'] = round(campaign_cost,2)
-    ra_segs = pd.concat([ra_segs, temp])
+campaign_costs = ftm_campaigns.set_index('Campaign Name')['Total Cost (USD)']
+ra_segs = get_ra_segments(cube_df, ftm_apps['total_lvls'][0], by='campaign', costs=campaign_costs, weights='la')
+ra_segs['la_perc'] = round(ra_segs['la_perc'], 2)
+ra_segs['campaign_cost'] = round(ra_segs['campaign'].map(campaign_costs), 2)
 ra_segs = ra_segs.sort_values(by=['campaign'])
 
 ra_segs_fig = px.bar(ra_segs,
@@ -0,0 +1,75 @@
+# test_cache.py
+import os
+import time
+import pandas as pd
+from ftm_cache import disk_cache, get_entries, get_cache_key
+
+def make_loader(cache_dir, calls, **kwargs):
+    @disk_cache(cache_dir=str(cache_dir), **kwargs)
+    def load(*args):
+        calls.append(args)
+        return pd.DataFrame({'value': [len(calls)]})
+    return load
+
+def test_second_call_reads_disk(tmp_path):
+    calls = []
+    load = make_loader(tmp_path, calls)
+    first = load('a')
+    second = load('a')
+    assert calls == [('a',)]
+    pd.testing.assert_frame_equal(first, second)
+    load('b')
+    assert calls == [('a',), ('b',)]
+
+def test_expired_entry_is_reloaded_but_kept_as_stale(tmp_path):
+    calls = []
+    load = make_loader(tmp_path, calls, ttl=60)
+    load('a')
+    path = get_entries(str(tmp_path))[0][0]
+    old = time.time() - 120
+    os.utime(path, (old, old))
+    assert load.read_stale('a')['value'].item() == 1
+    assert load('a')['value'].item() == 2
+    assert len(calls) == 2
+
+def test_versioned_write_drops_other_versions(tmp_path):
+    calls = []
+    load = make_loader(tmp_path, calls, versioned=True)
+    load('v1', 'x')
+    load('v2', 'x')
+    assert len(get_entries(str(tmp_path))) == 1
+    # The nearest entry of another version serves as the stale fallback.
+    assert load.read_stale('v3', 'x')['value'].item() == 2
+    assert load.read_stale('v3', 'y') is None
+
+def test_evicts_least_recently_used_over_cap(tmp_path):
+    calls = []
+    load = make_loader(tmp_path, calls, max_bytes=0)
+    load('a')
+    assert get_entries(str(tmp_path)) == []
+
+LOADER_SOURCE = """
+def load(day):
+    def parse(sql_query):
+        return sql_query
+    return parse(f"SELECT * FROM {table} WHERE day = '{{day}}'")
+"""
+
+def compile_loader(table):
+    # A fresh code object per call, as each server process compiles its own.
+    namespace = {}
+    exec(compile(LOADER_SOURCE.format(table=table), 'loader', 'exec'), namespace)
+    return namespace['load']
+
+def test_key_changes_when_only_constants_change():
+    # Same bytecode, different SQL: a deploy that edits a query must not read
+    # the results of the old one.
+    load_a, load_b = compile_loader('a'), compile_loader('b')
+    assert load_a.__code__.co_code == load_b.__code__.co_code
+    assert get_cache_key(load_a, ('x',), {}) != get_cache_key(load_b, ('x',), {})
+    assert get_cache_key(load_a, ('v1', 'x'), {}, versioned=True) != get_cache_key(load_b, ('v1', 'x'), {}, versioned=True)
+
+def test_key_is_stable_across_compilations():
+    load_a, load_b = compile_loader('a'), compile_loader('a')
+    assert load_a.__code__ is not load_b.__code__
+    assert get_cache_key(load_a, ('x',), {}) == get_cache_key(load_b, ('x',), {})
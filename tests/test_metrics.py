@@ -0,0 +1,183 @@
+# test_metrics.py
+# ftm_metrics checked against the per-row and per-campaign code it replaced.
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from ftm_metrics import (get_ra_deciles, get_ra_segments, build_campaign_index, select_campaign_users,
+    build_country_dim, get_country_la, get_rolling_la, get_normalized_start_df, downsample_series)
+
+def get_baseline_deciles(ra):
+    # The if/elif ladder every page had before ftm_metrics.
+    seg = []
+    for perc in ra:
+        if perc < .1:
+            seg.append(.1)
+        elif .1 <= perc < .2:
+            seg.append(.2)
+        elif .2 <= perc < .3:
+            seg.append(.3)
+        elif .3 <= perc < .4:
+            seg.append(.4)
+        elif .4 <= perc < .5:
+            seg.append(.5)
+        elif .5 <= perc < .6:
+            seg.append(.6)
+        elif .6 <= perc < .7:
+            seg.append(.7)
+        elif .7 <= perc < .8:
+            seg.append(.8)
+        elif .8 <= perc < .9:
+            seg.append(.9)
+        else:
+            seg.append(1)
+    return seg
+
+def get_baseline_segments(user_data, total_lvls, campaign_cost=None):
+    user_data = user_data.copy()
+    user_data['ra'] = user_data['max_lvl'] / total_lvls
+    user_data['seg'] = get_baseline_deciles(user_data['ra'])
+    res = user_data.groupby('seg').agg(la=('user_pseudo_id','count'), ra=('ra','mean')).reset_index()
+    res['la_perc'] = res['la'] / res['la'].sum()
+    if campaign_cost is not None:
+        res['rac'] = round(campaign_cost * res['la_perc'] / (res['ra'] * res['la'].sum()),2)
+    return res
+
+def make_users(n=2000, seed=0):
+    rng = np.random.default_rng(seed)
+    max_lvl = rng.integers(0, 70, n).astype('float64')
+    # Unknown levels fall in the top bucket, as in the baseline.
+    max_lvl[rng.random(n) < .02] = np.nan
+    return pd.DataFrame({
+        'user_pseudo_id': [f'u{i}' for i in range(n)],
+        'max_lvl': max_lvl,
+        'campaign': rng.choice(['a', 'b', 'c'], n),
+    })
+
+@pytest.mark.parametrize('total_lvls', [10, 30, 60, 7])
+def test_deciles_match_baseline_ladder(total_lvls):
+    # Every level up to total_lvls + 2, so each decile edge is hit exactly.
+    ra = np.append(np.arange(total_lvls + 3) / total_lvls, [np.nan, -0.0])
+    assert list(get_ra_deciles(ra)) == get_baseline_deciles(ra)
+
+def test_segments_match_baseline():
+    users = make_users()
+    res = get_ra_segments(users, 60, costs=1000.0)
+    expected = get_baseline_segments(users, 60, campaign_cost=1000.0)
+    pd.testing.assert_frame_equal(res[expected.columns], expected, check_dtype=False)
+
+def test_segments_by_campaign_match_baseline_per_campaign():
+    users = make_users()
+    costs = pd.Series({'a': 100.0, 'b': 200.0, 'c': 300.0})
+    res = get_ra_segments(users, 60, by='campaign', costs=costs)
+    for campaign, cost in costs.items():
+        expected = get_baseline_segments(users[users['campaign'] == campaign], 60, campaign_cost=cost)
+        got = res[res['campaign'] == campaign].reset_index(drop=True)
+        pd.testing.assert_frame_equal(got[expected.columns], expected, check_dtype=False)
+
+def test_weighted_segments_match_learner_rows():
+    # The cube's la weights give the same deciles as its expanded learner rows.
+    users = make_users().dropna(subset=['max_lvl'])
+    cube = users.groupby(['campaign', 'max_lvl']).size().reset_index(name='la')
+    res = get_ra_segments(cube, 60, by='campaign', weights='la')
+    expected = get_ra_segments(users, 60, by='campaign')
+    pd.testing.assert_frame_equal(res, expected)
+
+def make_campaign_users(seed=0):
+    rng = np.random.default_rng(seed)
+    n = 3000
+    return pd.DataFrame({
+        'user_pseudo_id': [f'u{i}' for i in range(n)],
+        'app_id': pd.Categorical(rng.choice(['app.x', 'app.y'], n)),
+        'country': pd.Categorical(rng.choice(['India', 'Kenya', 'Peru'], n)),
+        'LA_date': pd.Timestamp('2022-01-01') + pd.to_timedelta(rng.integers(0, 120, n), unit='D'),
+        'max_lvl': rng.integers(0, 60, n),
+    })
+
+def make_campaigns():
+    return pd.DataFrame({
+        'Campaign Name': ['kenya-x', 'all-x', 'india-y', 'overlap-kenya-x', 'empty', 'unknown-app'],
+        'app_id': ['app.x', 'app.x', 'app.y', 'app.x', 'app.y', 'app.z'],
+        'Country': ['Kenya', 'All', 'India', 'Kenya', 'Peru', 'Kenya'],
+        'Start Date': pd.to_datetime(['2022-01-10', '2022-02-01', '2022-01-01', '2022-01-20', '2022-03-01', '2022-01-01']).date,
+        'End Date': pd.to_datetime(['2022-02-10', '2022-02-28', '2022-04-30', '2022-03-01', '2022-02-01', '2022-04-30']).date,
+    })
+
+def get_baseline_selection(users, campaigns):
+    # One mask per campaign, concatenated, as Campaign Comparison Details did.
+    res = pd.DataFrame()
+    for _, row in campaigns.iterrows():
+        mask = ((users['LA_date'] >= pd.Timestamp(row['Start Date'])) & (users['LA_date'] <= pd.Timestamp(row['End Date']))
+            & (users['app_id'] == row['app_id']))
+        if row['Country'] != 'All':
+            mask &= users['country'] == row['Country']
+        temp = users[mask].copy()
+        temp['campaign'] = row['Campaign Name']
+        res = pd.concat([res, temp])
+    return res
+
+def sort_selection(df):
+    return df.astype({'app_id': str, 'country': str}).sort_values(['campaign', 'user_pseudo_id']).reset_index(drop=True)
+
+def test_campaign_selection_matches_baseline():
+    users = make_campaign_users()
+    campaigns = make_campaigns()
+    res = select_campaign_users(users, build_campaign_index(users), campaigns)
+    expected = get_baseline_selection(users, campaigns)
+    pd.testing.assert_frame_equal(sort_selection(res), sort_selection(expected))
+
+def test_overlapping_campaigns_keep_their_own_copies():
+    users = make_campaign_users()
+    campaigns = make_campaigns()
+    res = select_campaign_users(users, build_campaign_index(users), campaigns)
+    shared = set(res.loc[res['campaign'] == 'kenya-x', 'user_pseudo_id']) & set(res.loc[res['campaign'] == 'overlap-kenya-x', 'user_pseudo_id'])
+    assert shared
+    assert not res.duplicated(['campaign', 'user_pseudo_id']).any()
+
+def make_daily_la():
+    rng = np.random.default_rng(0)
+    frames = []
+    for campaign, start in [('b', '2022-03-05'), ('a', '2022-01-01')]:
+        dates = pd.Timestamp(start) + pd.to_timedelta(np.sort(rng.choice(90, 60, replace=False)), unit='D')
+        frames.append(pd.DataFrame({'campaign': campaign, 'LA_date': dates, 'LA': rng.integers(1, 50, 60)}))
+    return pd.concat(frames, ignore_index=True)
+
+def test_rolling_la_rolls_within_each_campaign():
+    daily_la = make_daily_la()
+    res = get_rolling_la(daily_la)
+    for campaign, rows in res.groupby('campaign'):
+        expected = daily_la[daily_la['campaign'] == campaign].sort_values('LA_date')['LA'].rolling(7).mean()
+        np.testing.assert_allclose(rows['Weekly Rolling Mean'], expected, equal_nan=True)
+    assert 'Weekly Rolling Mean' not in daily_la
+
+def test_normalized_start_counts_calendar_days():
+    daily_la = make_daily_la()
+    res = get_normalized_start_df(daily_la)
+    for campaign, rows in res.groupby('campaign'):
+        start = rows['LA_date'].min()
+        assert list(rows['day']) == [(date - start).days + 1 for date in rows['LA_date']]
+
+def test_downsample_keeps_ends_and_limit():
+    daily_la = get_rolling_la(make_daily_la())
+    res = downsample_series(daily_la, 'LA_date', 'Weekly Rolling Mean', 'campaign', max_points=20)
+    assert res['Weekly Rolling Mean'].notna().all()
+    for campaign, rows in res.groupby('campaign'):
+        series = daily_la[(daily_la['campaign'] == campaign) & daily_la['Weekly Rolling Mean'].notna()]
+        assert len(rows) == 20
+        assert rows['LA_date'].iloc[0] == series['LA_date'].iloc[0]
+        assert rows['LA_date'].iloc[-1] == series['LA_date'].iloc[-1]
+
+def test_downsample_returns_short_series_whole():
+    daily_la = make_daily_la()
+    res = downsample_series(daily_la, 'LA_date', 'LA', 'campaign', max_points=500)
+    pd.testing.assert_frame_equal(res, daily_la)
+
+def test_territories_keep_their_la():
+    countries = build_country_dim(pd.read_csv(os.path.join(os.path.dirname(__file__), '..', 'countries.csv'),
+        keep_default_na=False))
+    assert countries['ga_name'].is_unique and countries['alpha3'].is_unique
+    names = ['Palestine', 'Hong Kong', 'Taiwan', 'Puerto Rico', 'Kosovo', 'Réunion', 'Kenya']
+    iso3 = countries.set_index('ga_name')['alpha3']
+    cube = pd.DataFrame({'country_iso3': pd.Categorical(pd.Series(names).map(iso3)), 'la': 1})
+    res = get_country_la(cube, countries, weights='la')
+    assert sorted(res['country_iso3']) == ['HKG', 'KEN', 'PRI', 'PSE', 'REU', 'TWN', 'XKX']
@@ -0,0 +1,21 @@
+# test_queries.py
+import pytest
+from ftm_queries import get_aggregate_sql
+
+def test_groups_by_dimensions_and_names_measures():
+    sql_query = get_aggregate_sql('p.d.cube', ['la', 'max_lvl_sum'], ['LA_date', 'country'])
+    assert 'SELECT LA_date, country, SUM(la) AS la, SUM(max_lvl * la) AS max_lvl_sum' in sql_query
+    assert 'FROM `p.d.cube`' in sql_query
+    assert 'GROUP BY LA_date, country' in sql_query
+    assert 'country IN UNNEST(@countries)' in sql_query
+
+def test_totals_without_group_by_or_country_filter():
+    sql_query = get_aggregate_sql('p.d.cube', ['la'], countries=False)
+    assert 'GROUP BY' not in sql_query
+    assert '@countries' not in sql_query
+    assert 'WHERE LA_date BETWEEN @start AND @end' in sql_query
+
+@pytest.mark.parametrize('measures, by', [(['la; DROP TABLE x'], []), (['la'], ['user_pseudo_id'])])
+def test_rejects_unknown_columns(measures, by):
+    with pytest.raises(ValueError):
+        get_aggregate_sql('p.d.cube', measures, by)
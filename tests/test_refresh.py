@@ -0,0 +1,154 @@
+# test_refresh.py
+# Runs ftm_refresh's incremental statements on sqlite3 against synthetic event
+# shards and checks that, pass after pass, they leave ftm_users, the cube and
+# the daily activity equal to a full rebuild of the same shards.
+import sqlite3
+import datetime
+import numpy as np
+import pandas as pd
+import pytest
+from ftm_refresh import (TABLES, get_full_refresh_statements, get_refresh_statements, get_daily_activity_sql,
+    refresh_incremental)
+
+START = datetime.date(2023, 1, 1)
+N_DAYS = 20
+TRACKS = [('app.x', 'India'), ('app.x', 'Kenya'), ('app.y', 'India')]
+
+def make_shards(n_users=300, seed=0):
+    # Level events of learners playing one or more (app, country) tracks. Some
+    # tracks fail level 1 on a day before they first pass it; from then on they
+    # climb, with some LevelFail events at the next level.
+    rng = np.random.default_rng(seed)
+    tracks = {f'u{i}': [TRACKS[t] for t in rng.choice(len(TRACKS), rng.integers(1, 3), replace=False)]
+        for i in range(n_users)}
+    progress = {}
+    rows = []
+    for day in range(N_DAYS):
+        date = START + datetime.timedelta(days=day)
+        for user in rng.choice(list(tracks), n_users // 4, replace=False):
+            app_id, country = tracks[user][rng.integers(len(tracks[user]))]
+            lvl = progress.get((user, app_id, country), 0)
+            if lvl == 0 and rng.random() < .3:
+                rows.append((date.strftime('%y%m%d'), user, date.isoformat(), app_id, country, 1, 0))
+                continue
+            for _ in range(rng.integers(1, 4)):
+                lvl += 1
+                rows.append((date.strftime('%y%m%d'), user, date.isoformat(), app_id, country, lvl, 1))
+                if rng.random() < .5:
+                    rows.append((date.strftime('%y%m%d'), user, date.isoformat(), app_id, country, lvl + 1, 0))
+            progress[(user, app_id, country)] = lvl
+    return pd.DataFrame(rows, columns=['suffix', 'user_pseudo_id', 'event_date', 'app_id', 'country', 'lvl', 'succeeded'])
+
+def get_full_tables(shards):
+    # What a full rebuild (ftm_refresh.get_full_refresh_sql and friends) holds.
+    wins = shards[shards['succeeded'] == 1]
+    users = wins[wins['lvl'] == 1].groupby(['user_pseudo_id', 'app_id', 'country'], as_index=False)['event_date'].min()
+    users = users.rename(columns={'event_date': 'LA_date'})
+    max_lvl = wins.groupby('user_pseudo_id')['lvl'].max().rename('max_lvl')
+    at_max = wins.merge(max_lvl, left_on=['user_pseudo_id', 'lvl'], right_on=['user_pseudo_id', 'max_lvl'])
+    per_user = pd.concat([
+        max_lvl,
+        at_max.groupby('user_pseudo_id')['event_date'].min().rename('max_lvl_date'),
+        wins.groupby('user_pseudo_id').size().rename('total_lvls_succeeded'),
+    ], axis=1).reset_index()
+    users = users.merge(per_user, on='user_pseudo_id')
+    cube = users.groupby(['app_id', 'country', 'LA_date', 'max_lvl'], as_index=False).size().rename(columns={'size': 'la'})
+    activity = shards.merge(users[['user_pseudo_id', 'app_id', 'country', 'LA_date']], on=['user_pseudo_id', 'app_id', 'country'])
+    activity = activity[activity['event_date'] >= activity['LA_date']]
+    activity = activity.groupby(['app_id', 'country', 'LA_date', 'event_date'], as_index=False).size()
+    return {'users': users, 'cube': cube, 'activity': activity.rename(columns={'size': 'levels_played'})}
+
+def make_db(shards):
+    # Empty tables, with the state just before the first shard.
+    db = sqlite3.connect(':memory:')
+    shards.to_sql('shards', db, index=False)
+    db.execute('CREATE TABLE users (user_pseudo_id TEXT, LA_date TEXT, app_id TEXT, country TEXT, '
+        'max_lvl INT, max_lvl_date TEXT, total_lvls_succeeded INT)')
+    db.execute('CREATE TABLE cube (app_id TEXT, country TEXT, LA_date TEXT, max_lvl INT, la INT)')
+    db.execute('CREATE TABLE activity (app_id TEXT, country TEXT, LA_date TEXT, event_date TEXT, levels_played INT)')
+    db.execute('CREATE TABLE state (last_suffix TEXT)')
+    db.execute('INSERT INTO state VALUES (?)', ((START - datetime.timedelta(days=1)).strftime('%y%m%d'),))
+    return db
+
+# The latest shard the synthetic shards table holds, as get_latest_suffix_sql
+# reads from INFORMATION_SCHEMA.
+LATEST_SUFFIX_SQL = 'SELECT MAX(suffix) FROM shards'
+
+def get_events_sql(start, end):
+    return f"""
+        SELECT user_pseudo_id, event_date, app_id, country, lvl, succeeded
+        FROM shards WHERE suffix BETWEEN '{start}' AND '{end}'
+    """
+
+def read_table(db, name, keys):
+    df = pd.read_sql(f'SELECT * FROM {name}', db)
+    return df.sort_values(keys).reset_index(drop=True)
+
+def assert_tables_equal(db, expected):
+    keys = {
+        'users': ['user_pseudo_id', 'app_id', 'country'],
+        'cube': ['app_id', 'country', 'LA_date', 'max_lvl'],
+        'activity': ['app_id', 'country', 'LA_date', 'event_date'],
+    }
+    for name, key in keys.items():
+        got = read_table(db, name, key)
+        want = expected[name][got.columns].sort_values(key).reset_index(drop=True)
+        pd.testing.assert_frame_equal(got, want, check_dtype=False)
+
+@pytest.mark.parametrize('pass_days', [1, 3, N_DAYS])
+def test_incremental_passes_match_full_rebuild(pass_days):
+    shards = make_shards()
+    db = make_db(shards)
+    tables = {name: name for name in TABLES}
+    run = lambda sql_query: db.execute(sql_query).fetchall()
+    for day in range(pass_days, N_DAYS + pass_days, pass_days):
+        today = START + datetime.timedelta(days=min(day, N_DAYS))
+        refresh_incremental(run, get_events_sql, LATEST_SUFFIX_SQL, today, tables)
+        processed = shards[shards['suffix'] < today.strftime('%y%m%d')]
+        assert_tables_equal(db, get_full_tables(processed))
+    assert refresh_incremental(run, get_events_sql, LATEST_SUFFIX_SQL, today, tables) is None
+
+def test_late_shard_is_read_by_the_next_run():
+    # The run on day 6 finds day 5 not exported yet; it must stop at day 4 and
+    # leave day 5 to the next run instead of recording it as done.
+    shards = make_shards()
+    late = (START + datetime.timedelta(days=5)).strftime('%y%m%d')
+    db = make_db(shards[shards['suffix'] < late])
+    tables = {name: name for name in TABLES}
+    run = lambda sql_query: db.execute(sql_query).fetchall()
+    today = START + datetime.timedelta(days=6)
+    assert refresh_incremental(run, get_events_sql, LATEST_SUFFIX_SQL, today, tables)[1] < late
+    shards[shards['suffix'] == late].to_sql('shards', db, index=False, if_exists='append')
+    assert refresh_incremental(run, get_events_sql, LATEST_SUFFIX_SQL, today, tables) == (late, late)
+    assert_tables_equal(db, get_full_tables(shards[shards['suffix'] <= late]))
+
+def test_activity_before_la_date_is_not_counted():
+    # Fail level 1 on day 1, pass it on day 2, one pass per day. The full rebuild's
+    # activity SQL over the same shards must give the rows the passes appended.
+    days = [START.strftime('%y%m%d'), (START + datetime.timedelta(days=1)).strftime('%y%m%d')]
+    shards = pd.DataFrame([
+        (days[0], 'u0', START.isoformat(), 'app.x', 'India', 1, 0),
+        (days[1], 'u0', (START + datetime.timedelta(days=1)).isoformat(), 'app.x', 'India', 1, 1),
+    ], columns=['suffix', 'user_pseudo_id', 'event_date', 'app_id', 'country', 'lvl', 'succeeded'])
+    db = make_db(shards)
+    tables = {name: name for name in TABLES}
+    run = lambda sql_query: db.execute(sql_query).fetchall()
+    for day in (1, 2):
+        refresh_incremental(run, get_events_sql, LATEST_SUFFIX_SQL, START + datetime.timedelta(days=day), tables)
+    la_date = shards['event_date'][1]
+    full = db.execute(get_daily_activity_sql('shards', 'users')).fetchall()
+    assert db.execute('SELECT * FROM activity').fetchall() == full == [('app.x', 'India', la_date, la_date, 1)]
+
+def test_state_table_is_created_before_use():
+    statements = get_full_refresh_statements([('proj', '123')], '230101')
+    create = next(i for i, sql_query in enumerate(statements) if 'CREATE TABLE IF NOT EXISTS' in sql_query)
+    assert TABLES['state'] in statements[create]
+    assert create < min(i for i, sql_query in enumerate(statements) if TABLES['state'] in sql_query and i != create)
+
+def test_full_refresh_drops_its_staging_table():
+    statements = get_full_refresh_statements([('proj', '123')], '230101')
+    assert statements[-1] == f"DROP TABLE `{TABLES['events']}`"
+
+def test_refresh_statements_record_the_last_shard():
+    statements = get_refresh_statements(get_events_sql('230101', '230105'), '230105')
+    assert statements[-1] == f"INSERT INTO `{TABLES['state']}` (last_suffix) VALUES ('230105')"
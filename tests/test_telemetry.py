@@ -0,0 +1,29 @@
+# test_telemetry.py
+# Loader telemetry records, checked for what they must not leak.
+import logging
+import pytest
+from ftm_telemetry import traced, get_records, logger
+
+SHEET_URL = 'https://docs.google.com/spreadsheets/d/secret-sheet-id/edit'
+
+def test_sheet_urls_are_not_recorded(caplog):
+    @traced('sheets')
+    def load_sheet(revision, sheet_url):
+        raise ValueError(f'Could not read {sheet_url}')
+    logger.propagate = True
+    try:
+        with caplog.at_level(logging.INFO, logger=logger.name), pytest.raises(ValueError):
+            load_sheet('r1', SHEET_URL)
+    finally:
+        logger.propagate = False
+    record = get_records().iloc[-1]
+    assert record['args'].startswith('sha1:')
+    assert record['error'] == 'ValueError'
+    assert 'secret-sheet-id' not in caplog.text
+
+def test_query_args_are_recorded():
+    @traced('bigquery')
+    def load_rows(version, app):
+        return None
+    load_rows('v1', 'app.x')
+    assert get_records().iloc[-1]['args'] == "('v1', 'app.x')"